@@ -1,48 +1,341 @@
 # MADE BY @C4GWN
 # WWW.PYROLLC.COM.TR
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, send_file
+import atexit
+import base64
+import binascii
+import bisect
+import click
+import hashlib
+import heapq
+import io
+import itertools
 import json
+import math
+import mmap
 import os
+import queue
+import re
+import sqlite3
+import sys
+import threading
+import time
+import unicodedata
 import uuid
-from datetime import datetime, timedelta
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
 
 app = Flask(__name__)
 app.config['JSON_AS_ASCII'] = False
+# 'json' (bellek + journal) veya 'sqlite'
+app.config['STORAGE_BACKEND'] = os.environ.get('STORAGE_BACKEND', 'json')
 DB_PATH = 'database.json'
+JOURNAL_PATH = 'database.journal'
+SQLITE_PATH = 'database.sqlite3'
+BLOB_PATH = 'attachments'
+# Olay akışında bu kadar saniye sessizlik olursa ping gönderilir
+GATEWAY_HEARTBEAT = 15
+# /changes için bellekte tutulan son değişiklik sayısı ve en uzun bekleme süresi
+CHANGE_RING_SIZE = 10000
+CHANGES_MAX_TIMEOUT = 60
+# Bu kadar saniye heartbeat gelmeyen kullanıcı çevrimdışı sayılır
+PRESENCE_TTL = 90
+# Bu kadar saniye heartbeat gelmeyen ses oturumu kapatılır
+VOICE_TTL = 90
+# 'strict': yazı diske fsync edildikten sonra onaylanır
+# 'relaxed': yazı bellekte uygulanır uygulanmaz onaylanır, disk bir sonraki
+# toplu yazımda güncellenir (çökmede son birkaç milisaniye kaybolabilir)
+app.config['JOURNAL_DURABILITY'] = os.environ.get('JOURNAL_DURABILITY', 'strict')
+# Toplu commit: bir fsync sürerken gelen yazılar zaten bir sonraki toplu
+# yazıma girer. Pencere > 0 ise ayrıca bu kadar saniye (ya da bu kadar op
+# birikene kadar) beklenir; fsync'i yavaş disklerde toplu yazımı büyütür.
+GROUP_COMMIT_WINDOW = float(os.environ.get('GROUP_COMMIT_WINDOW_MS', '0')) / 1000
+GROUP_COMMIT_MAX_OPS = 256
+# Aktif journal bu boyutu aşınca ya da son snapshot'tan bu kadar saniye
+# geçince arka planda yeni snapshot alınır ve journal sıkıştırılır
+SNAPSHOT_INTERVAL = 300
+SNAPSHOT_JOURNAL_BYTES = 64 * 1024 * 1024
+# Snowflake kimlikleri: 41 bit milisaniye (SNOWFLAKE_EPOCH'tan beri), 10 bit
+# işçi numarası, 12 bit sıra. Aynı veriye yazan her süreç farklı WORKER_ID almalı.
+SNOWFLAKE_EPOCH = 1704067200000  # 2024-01-01T00:00:00Z, milisaniye
+WORKER_ID = int(os.environ.get('WORKER_ID', '0'))
+# Kanal başına bellekte tutulan son mesaj sayısı (en büyük sayfa boyutu
+# kadar) ve tüm kanallar için toplam yaklaşık bellek bütçesi
+RECENT_MESSAGES = 100
+RECENT_CACHE_BYTES = int(os.environ.get('RECENT_CACHE_MB', '64')) * 1024 * 1024
+# Önbellekte tutulan en fazla GET yanıtı sayısı (bkz. cached_json)
+RESPONSE_CACHE_SIZE = 1024
+# Akışla gönderilen listeler bu boyuta kadar önbelleğe de yazılır; daha
+# büyükleri her seferinde sabit bellekle yeniden üretilir
+RESPONSE_CACHE_MAX_BODY = 1024 * 1024
+# Akışla gönderilen listelerde her parça bu kadar eleman içerir
+STREAM_BATCH = 500
 
 ##########################
 # Yardımcı Fonksiyonlar #
 ##########################
 
+_store = None
+_store_lock = threading.Lock()
+_mutation_listeners = []
+
+class SnowflakeGenerator:
+    """
+    Zamana göre sıralı 64 bit kimlikler üretir. Aynı milisaniyede 4096'dan
+    fazla kimlik istenirse ya da saat geri giderse, sıralamayı bozmamak
+    için son kullanılan milisaniyenin bir sonrakine geçilir.
+    """
+
+    def __init__(self, worker_id):
+        if not 0 <= worker_id < 1024:
+            raise ValueError("WORKER_ID must be between 0 and 1023")
+        self.worker_id = worker_id
+        self.lock = threading.Lock()
+        self.last_ms = -1
+        self.sequence = 0
+
+    def next_id(self):
+        with self.lock:
+            now = max(int(time.time() * 1000), self.last_ms)
+            if now == self.last_ms:
+                self.sequence = (self.sequence + 1) & 0xFFF
+                if self.sequence == 0:
+                    now += 1
+            else:
+                self.sequence = 0
+            self.last_ms = now
+            return ((now - SNOWFLAKE_EPOCH) << 22) | (self.worker_id << 12) | self.sequence
+
+snowflakes = SnowflakeGenerator(WORKER_ID)
+
+def new_id():
+    """
+    Yeni bir snowflake kimliği. JSON'da ondalık string olarak taşınır;
+    JavaScript istemcileri 64 bit tamsayıyı kayıpsız okuyamaz.
+    """
+    return str(snowflakes.next_id())
+
+def snowflake_datetime(value):
+    """
+    Snowflake kimliğinin oluşturulma zamanı (UTC); kimlik snowflake değilse
+    (ör. eski UUID'ler) None.
+    """
+    # isdigit() tek başına '²' gibi Unicode rakamlarını da kabul eder
+    if not isinstance(value, str) or not (value.isascii() and value.isdigit()) or len(value) > 19:
+        return None
+    ms = (int(value) >> 22) + SNOWFLAKE_EPOCH
+    return datetime(1970, 1, 1) + timedelta(milliseconds=ms)
+
+def empty_db():
+    return {
+        "users": [],
+        "guilds": [],
+        "messages": [],
+        "direct_messages": [],
+        "friend_requests": []
+    }
+
 def load_db():
-    if not os.path.exists(DB_PATH):
-        with open(DB_PATH, 'w', encoding='utf-8') as f:
-            json.dump({
-                "users": [],
-                "guilds": [],
-                "messages": [],
-                "direct_messages": [],
-                "friend_requests": []
-            }, f, ensure_ascii=False, indent=4)
-    with open(DB_PATH, 'r', encoding='utf-8') as f:
-        return json.load(f)
-
-def save_db(db):
-    with open(DB_PATH, 'w', encoding='utf-8') as f:
-        json.dump(db, f, ensure_ascii=False, indent=4)
+    """
+    Yapılandırılan depolama motorunu döndürür (JsonStore veya SqliteStore).
+    İlk çağrıda açılır; sonraki çağrılar aynı nesneyi verir.
+    """
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                if app.config['STORAGE_BACKEND'] == 'sqlite':
+                    _store = SqliteStore(SQLITE_PATH)
+                else:
+                    store = JsonStore(DB_PATH, JOURNAL_PATH)
+                    store.start_compaction()
+                    _store = store
+    return _store
+
+def save_db(db, path=None, indent=4):
+    """
+    Dosyayı geçici bir kopyaya yazıp atomik olarak yerine koyar; okuyan biri
+    ya eski ya yeni dosyayı görür, yarım yazılmış JSON'u asla görmez.
+    """
+    path = path or DB_PATH
+    tmp = f'{path}.{uuid.uuid4().hex}.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(db, f, ensure_ascii=False, indent=indent)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    fsync_dir(path)
+
+def fsync_dir(path):
+    # Yeniden adlandırmanın kendisinin de çökmeye dayanması için dizin fsync'lenir
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class PartitionLocks:
+    """
+    Yazma kilitleri bölüm (partition) bazında şeritlenir: her sunucu kendi
+    şeridine, DM'ler ve kullanıcılar kendi şeritlerine, arkadaşlık istekleri
+    tek bir kilide düşer. Farklı sunuculara yazan istekler birbirini beklemez.
+    Birden çok bölüme dokunan kod kilitleri hold() ile tek seferde alır;
+    kilitler her zaman şerit sırasına göre alındığı için kilitlenme olmaz.
+    """
+
+    USER_STRIPES = 16
+    DM_STRIPES = 16
+    GUILD_STRIPES = 64
+
+    def __init__(self):
+        # Sabit sıra: kullanıcılar, arkadaşlık istekleri, DM'ler, sunucular
+        self.bases = {
+            'user': 0,
+            'friend_request': self.USER_STRIPES,
+            'dm': self.USER_STRIPES + 1,
+            'guild': self.USER_STRIPES + 1 + self.DM_STRIPES,
+        }
+        self.sizes = {'user': self.USER_STRIPES, 'friend_request': 1,
+                      'dm': self.DM_STRIPES, 'guild': self.GUILD_STRIPES}
+        total = self.bases['guild'] + self.GUILD_STRIPES
+        self.stripes = [threading.RLock() for _ in range(total)]
+        self.local = threading.local()
+
+    def stripe(self, kind, key):
+        return self.bases[kind] + hash(key) % self.sizes[kind]
+
+    @contextmanager
+    def hold(self, *partitions):
+        """
+        partitions: ('guild', guild_id), ('user', username) gibi ikililer.
+        Aynı thread iç içe hold() çağırabilir; ancak dışarıda tutulan bir
+        şeritten daha düşük sıradaki yeni bir şerit istenirse hata verir.
+        """
+        held = getattr(self.local, 'held', None)
+        if held is None:
+            held = self.local.held = []
+        wanted = sorted({self.stripe(kind, key) for kind, key in partitions} - set(held))
+        if wanted and held and wanted[0] < max(held):
+            raise RuntimeError('partition locks must be taken in stripe order')
+        for i in wanted:
+            self.stripes[i].acquire()
+            held.append(i)
+        try:
+            yield
+        finally:
+            for i in reversed(wanted):
+                held.remove(i)
+                self.stripes[i].release()
+
+partition_locks = PartitionLocks()
+
+# Op -> dokunduğu bölümler
+USER_OPS = {'add_user', 'update_user', 'add_friendship', 'add_user_guild',
+            'remove_user_guild', 'add_user_dm'}
+FRIEND_REQUEST_OPS = {'add_friend_request', 'remove_friend_request'}
+MESSAGE_OPS = {'add_message', 'edit_message', 'set_message_file', 'delete_message',
+               'pin_message', 'add_reaction', 'remove_reaction'}
+
+def op_partitions(db, op, args):
+    if op in USER_OPS:
+        if op == 'add_user':
+            return [('user', args['user']['username'])]
+        if op == 'add_friendship':
+            return [('user', args['user_a']), ('user', args['user_b'])]
+        return [('user', args['username'])]
+    if op in FRIEND_REQUEST_OPS:
+        return [('friend_request', None)]
+    if op == 'add_dm':
+        return [('dm', args['dm']['id'])]
+    if 'dm_id' in args:
+        return [('dm', args['dm_id'])]
+    if op == 'add_guild':
+        return [('guild', args['guild']['id'])]
+    if op in MESSAGE_OPS:
+        if op == 'add_message':
+            channel_id = args['message']['channel_id']
+        else:
+            # Silinmiş mesaj için None döner; op zaten hiçbir şey yapmaz
+            channel_id = db.message_channel_id(args['message_id'])
+        return [('guild', db.channel_guild_id(channel_id))]
+    return [('guild', args['guild_id'])]
+
+def op_resources(db, op, args):
+    """
+    Op'un değiştirdiği, yanıtı önbelleğe alınan kaynaklar: [(tür, id)].
+    Silinecek mesajın kanalı op'tan önce bulunmalıdır; commit() bunu op'u
+    uygulamadan çağırır.
+    """
+    if op in USER_OPS:
+        if op == 'add_user':
+            return [('user', args['user']['username']), ('users', None)]
+        if op == 'add_friendship':
+            return [('user', args['user_a']), ('user', args['user_b'])]
+        if op == 'update_user':
+            return [('user', args['username']), ('users', None)]
+        return [('user', args['username'])]
+    if op in MESSAGE_OPS:
+        if op == 'add_message':
+            return [('messages', args['message']['channel_id'])]
+        return [('messages', db.message_channel_id(args['message_id']))]
+    if op == 'add_guild':
+        return [('guild', args['guild']['id']), ('guilds', None)]
+    if op == 'add_audit_log':
+        return [('audit_logs', args['guild_id'])]
+    if op in ('add_member', 'remove_member'):
+        return [('guild', args['guild_id']), ('guilds', None)]
+    if 'guild_id' in args:
+        return [('guild', args['guild_id'])]
+    # Arkadaşlık istekleri ve DM'ler önbelleğe alınmıyor
+    return []
+
+def commit(op, **args):
+    """
+    Tek bir değişikliği depolama motoruna yazar ve uygular.
+    Rotalar veriyi doğrudan değiştirmez, her zaman bu fonksiyonu çağırır.
+    Yalnızca op'un bölüm kilitleri tutulur; dinleyiciler de aynı kilit altında
+    çalışır. Op uygulanıp dinleyiciler (ör. son mesaj önbelleği) güncellendikten
+    sonra dokunduğu kaynakların yanıt sürümleri artırılır; böylece yeni
+    sürümle okuyan bir istek eski veriyi görmez. Op'un dönüş değerini verir
+    (ör. add_user için kullanıcı zaten varsa False).
+    """
+    db = load_db()
+    with partition_locks.hold(*op_partitions(db, op, args)):
+        resources = op_resources(db, op, args)
+        result = db.commit(op, args)
+        for listener in _mutation_listeners:
+            listener(op, args)
+        response_cache.bump(resources)
+    return result
+
+def on_mutation(fn):
+    """
+    commit() sonrasında (op, args) ile çağrılacak bir dinleyici kaydeder;
+    bellekteki indeksler ve önbellekler bu yolla güncel tutulur.
+    """
+    _mutation_listeners.append(fn)
+    return fn
 
 def find_user(db, username):
-    for user in db['users']:
-        if user['username'] == username:
-            return user
-    return None
+    return db.find_user(username)
 
 def find_guild(db, guild_id):
-    for g in db['guilds']:
-        if g['id'] == guild_id:
-            return g
-    return None
+    return db.find_guild(guild_id)
+
+def guild_exists(db, guild_id):
+    return db.guild_exists(guild_id)
+
+def resolve_channel(db, channel_id, channel_type=None):
+    """
+    Kanalı ve sahibi olan sunucuyu döndürür: (guild, channel) veya (None, None).
+    channel_type verilirse ('voice' gibi) farklı tipteki kanallar bulunamamış sayılır.
+    """
+    guild, channel = db.find_channel(channel_id)
+    if channel and channel_type and channel.get('type') != channel_type:
+        return None, None
+    return guild, channel
 
 def find_channel_in_guild(guild, channel_id):
     for ch in guild['channels']:
@@ -57,10 +350,50 @@ def find_category_in_guild(guild, category_id):
     return None
 
 def find_dm(db, dm_id):
-    for dm in db['direct_messages']:
-        if dm['id'] == dm_id:
-            return dm
-    return None
+    return db.find_dm(dm_id)
+
+def find_dm_message(db, dm_id, message_id):
+    return db.find_dm_message(dm_id, message_id)
+
+def dm_messages_page(db, dm_id, limit, before=None, after=None):
+    """
+    channel_messages ile aynı sözleşme, DM mesajları için.
+    """
+    return db.dm_messages(dm_id, limit, before, after)
+
+def find_dm_between(db, user_a, user_b):
+    return db.find_dm_between(user_a, user_b)
+
+def find_invite(db, invite_id):
+    """
+    Davetiyeyi ve ait olduğu sunucuyu döndürür: (guild, invite) veya (None, None).
+    """
+    return db.find_invite(invite_id)
+
+def find_emoji_by_id(db, emoji_id):
+    return db.find_emoji(emoji_id)
+
+def find_guild_emoji(db, guild_id, emoji_id):
+    return db.find_guild_emoji(guild_id, emoji_id)
+
+def find_friend_request(db, request_id):
+    return db.find_friend_request(request_id)
+
+def friend_request_exists(db, from_user, to_user):
+    return db.friend_request_exists(from_user, to_user)
+
+def incoming_friend_requests(db, username):
+    return db.incoming_friend_requests(username)
+
+def user_summaries(db):
+    return db.user_summaries()
+
+def guild_summaries(db):
+    return db.guild_summaries()
+
+def guild_audit_logs(db, guild_id):
+    """Sunucunun denetim kayıtları (iterator); sunucu yoksa boştur."""
+    return db.audit_log_entries(guild_id)
 
 def find_user_by_token(db, token):
     # Basit token = username
@@ -72,29 +405,30 @@ def user_in_guild(guild, username):
             return m
     return None
 
+def is_guild_member(guild, username):
+    """
+    user_in_guild'in boolean karşılığı; üyelik yetki önbelleğinden okunur.
+    """
+    return permission_cache.is_member(guild, username)
+
 def user_has_permission(guild, username, permission):
     """
-    Kullanıcının sunucudaki rollerini inceler, 
-    eğer rollerden birinde 'permission' True ise yetkili kabul eder.
+    Kullanıcının sunucudaki rollerinden derlenmiş yetki maskesinde
+    'permission' biti açıksa yetkili kabul eder.
     """
-    member = user_in_guild(guild, username)
-    if not member:
-        return False
-    user_roles = member['roles']
-    for r in guild['roles']:
-        if r['name'] in user_roles:
-            if r['permissions'].get(permission, False):
-                return True
-    return False
+    return permission_cache.has_permission(guild, username, permission)
 
 def add_audit_log(guild, action, user, details=""):
-    guild['audit_logs'].append({
-        "id": str(uuid.uuid4()),
+    entry_id = new_id()
+    entry = {
+        "id": entry_id,
         "action": action,
         "user": user,
-        "timestamp": datetime.utcnow().isoformat(),
+        "timestamp": snowflake_datetime(entry_id).isoformat(),
         "details": details
-    })
+    }
+    commit('add_audit_log', guild_id=guild['id'], entry=entry)
+    publish_event('audit_log_create', {"entry": entry}, guild=guild)
 
 def create_default_role():
     return {
@@ -122,26 +456,98 @@ def create_admin_role():
     }
 
 def message_belongs_to_channel(db, message_id):
-    for m in db['messages']:
-        if m['id'] == message_id:
-            return m
-    return None
+    return db.find_message(message_id)
 
-def is_channel_private(channel):
-    return channel.get('is_private', False)
+def channel_messages(db, channel_id, limit, before=None, after=None):
+    """
+    Kanaldaki mesajlardan bir sayfa döndürür: (messages, has_more).
+    Mesajlar eskiden yeniye sıralıdır. before/after mesaj id'si olan
+    imleçlerdir; ikisi de yoksa en son 'limit' mesaj döner. İmleç bu kanala
+    ait bir mesaj değilse None döner. İmleçsiz istekler son mesaj
+    önbelleğinden karşılanır.
+    """
+    if before is None and after is None:
+        return recent_messages.latest(db, channel_id, limit)
+    return db.channel_messages(channel_id, limit, before, after)
 
-def user_has_access_to_channel(guild, user, channel):
+def parse_limit(default=50, maximum=100):
+    """
+    ?limit= parametresini okur; geçersizse None döner.
+    """
+    try:
+        limit = int(request.args.get('limit', default))
+    except ValueError:
+        return None
+    if limit < 1 or limit > maximum:
+        return None
+    return limit
+
+def iter_messages(db):
+    return db.iter_messages()
+
+def without_file_body(message):
     """
-    Kanal private ise allowed_roles listesine bak.
+    Mesajın file_base64 gövdesi olmadan bir kopyası; yalnızca ek olup olmadığı bildirilir.
+    Blob deposundaki ekler zaten yalnızca file_hash ile tutulur.
+    """
+    slim = {k: v for k, v in message.items() if k != 'file_base64'}
+    slim['has_file'] = bool(message.get('file_base64') or message.get('file_hash'))
+    return slim
+
+def image_mimetype(data):
+    """
+    Görselin türünü ilk baytlarından tahmin eder.
+    """
+    if data.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'image/png'
+    if data[:6] in (b'GIF87a', b'GIF89a'):
+        return 'image/gif'
+    if data.startswith(b'\xff\xd8\xff'):
+        return 'image/jpeg'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    return 'application/octet-stream'
+
+def decode_upload(file_base64):
+    """
+    İstekteki base64 (veya data: URL) eki çözer; geçersizse None döner.
+    """
+    if file_base64.startswith('data:') and ',' in file_base64:
+        file_base64 = file_base64.split(',', 1)[1]
+    try:
+        return base64.b64decode(file_base64, validate=True)
+    except (binascii.Error, ValueError):
+        return None
+
+def channel_readable(guild, user, channel):
+    """
+    /messages ile aynı kural: public kanal herkese açık, private kanal için
+    kullanıcının sunucuda olması ve izinli bir role sahip olması gerekir.
     """
     if not is_channel_private(channel):
         return True
-    member = user_in_guild(guild, user['username'])
-    if not member:
+    if not user:
         return False
-    user_roles = member['roles']
-    allowed = channel.get('allowed_roles', [])
-    return any(r in allowed for r in user_roles)
+    return user_has_access_to_channel(guild, user, channel)
+
+def is_channel_private(channel):
+    return channel.get('is_private', False)
+
+def user_has_access_to_channel(guild, user, channel):
+    """
+    Kanal private ise üyenin rolleri allowed_roles ile kesişmeli.
+    Sonuç (üye, kanal) başına önbelleğe alınır.
+    """
+    return permission_cache.can_access(guild, user['username'], channel)
+
+def emoji_image_hash(emoji):
+    """
+    Emoji görselinin sha256 özeti; taşınmamış eski emojiler için gövdeden hesaplanır.
+    """
+    if emoji.get('image_hash'):
+        return emoji['image_hash']
+    data = decode_upload(emoji.get('image_base64') or '')
+    return hashlib.sha256(data).hexdigest() if data else None
 
 def find_emoji(guild, emoji_id):
     for e in guild['emojis']:
@@ -157,6 +563,2778 @@ def invite_valid(invite):
         return False
     return True
 
+##########################
+# Depolama Motoru (WAL)  #
+##########################
+
+class GroupCommitJournal:
+    """
+    Journal'a yazan thread'ler satırlarını kuyruğa ekler; tek bir yazıcı
+    thread kısa bir pencere boyunca (GROUP_COMMIT_WINDOW veya
+    GROUP_COMMIT_MAX_OPS) biriken satırları tek write + fsync ile diske
+    indirir ve bekleyen herkesi birlikte uyandırır. fsync maliyeti böylece
+    istek başına değil, toplu yazım başına ödenir. Önceki toplu yazım tek
+    op'tan oluştuysa (eşzamanlı yazan yok) pencere beklenmez, satır hemen
+    diske iner; tek bir yazarın gecikmesi pencere kadar artmaz.
+    """
+
+    LATENCY_SAMPLES = 1024
+
+    def __init__(self, path, window, max_ops, durability):
+        self.path = path
+        self.file = open(path, 'a', encoding='utf-8')
+        # Dosya yazımı ile segment değişimini (rotate) birbirinden ayırır
+        self.io_lock = threading.Lock()
+        self.window = window
+        self.max_ops = max_ops
+        self.durability = durability
+        self.cond = threading.Condition()
+        self.pending = []
+        self.appended = 0
+        self.durable = 0
+        self.closed = False
+        # Yazıcı thread'i durduran G/Ç hatası (ör. ENOSPC, EIO)
+        self.error = None
+        self.batches = 0
+        self.ops = 0
+        self.max_batch = 0
+        self.last_batch = 0
+        self.latencies = deque(maxlen=self.LATENCY_SAMPLES)
+        self.thread = threading.Thread(target=self.run, name='journal-writer', daemon=True)
+        self.thread.start()
+
+    def append(self, line):
+        """
+        Satırı kuyruğa ekler. strict modda satır diske inene kadar bekler;
+        relaxed modda hemen döner. Yazıcı bir G/Ç hatasıyla durduysa (ya da
+        beklerken durursa) hata burada yeniden fırlatılır; istek 500 ile
+        sonlanır, op uygulanmaz.
+        """
+        with self.cond:
+            self.check()
+            self.pending.append(line)
+            self.appended += 1
+            seq = self.appended
+            if len(self.pending) == 1 or len(self.pending) >= self.max_ops:
+                self.cond.notify_all()
+            if self.durability == 'strict':
+                while self.durable < seq:
+                    self.check()
+                    self.cond.wait()
+
+    def check(self):
+        # Çağıran self.cond'u tutar
+        if self.error is not None:
+            raise OSError(self.error.errno, f"journal write failed: {self.error.strerror or self.error}",
+                          self.path) from self.error
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.pending and not self.closed:
+                    self.cond.wait()
+                if not self.pending:
+                    return
+                deadline = time.monotonic() + self.window
+                while self.last_batch > 1 and len(self.pending) < self.max_ops and not self.closed:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+                batch, self.pending = self.pending, []
+                last = self.appended
+            started = time.perf_counter()
+            try:
+                with self.io_lock:
+                    self.file.write(''.join(line + "\n" for line in batch))
+                    self.file.flush()
+                    os.fsync(self.file.fileno())
+            except OSError as e:
+                # Bekleyen ve sonraki yazarlar hatayı append() içinde alır
+                app.logger.exception("journal write failed")
+                with self.cond:
+                    self.error = e
+                    self.cond.notify_all()
+                return
+            elapsed = time.perf_counter() - started
+            with self.cond:
+                self.durable = last
+                self.batches += 1
+                self.ops += len(batch)
+                self.max_batch = max(self.max_batch, len(batch))
+                self.last_batch = len(batch)
+                self.latencies.append(elapsed)
+                self.cond.notify_all()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join()
+        with self.io_lock:
+            self.file.close()
+
+    def rotate(self, segment_path):
+        """
+        Aktif dosyayı segment_path adıyla kapatır ve boş bir dosyayla devam
+        eder. Toplu yazımlar arasında yapılır; bir op ya eski segmentte ya
+        yeni dosyadadır. Dosya boşsa hiçbir şey yapmaz ve False döner.
+        """
+        with self.io_lock:
+            if self.file.tell() == 0:
+                return False
+            self.file.close()
+            os.replace(self.path, segment_path)
+            self.file = open(self.path, 'a', encoding='utf-8')
+            fsync_dir(self.path)
+            return True
+
+    def size(self):
+        with self.io_lock:
+            return self.file.tell()
+
+    def stats(self):
+        with self.cond:
+            latencies = sorted(self.latencies)
+            batches, ops, max_batch = self.batches, self.ops, self.max_batch
+            pending = len(self.pending)
+
+        def percentile(p):
+            if not latencies:
+                return None
+            return round(latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000, 3)
+
+        return {
+            "durability": self.durability,
+            "window_ms": self.window * 1000,
+            "max_ops": self.max_ops,
+            "batches": batches,
+            "ops": ops,
+            "pending": pending,
+            "batch_size_avg": round(ops / batches, 2) if batches else None,
+            "batch_size_max": max_batch,
+            "flush_ms_p50": percentile(0.5),
+            "flush_ms_p99": percentile(0.99),
+            "flush_ms_max": round(latencies[-1] * 1000, 3) if latencies else None
+        }
+
+UNIX_EPOCH = datetime(1970, 1, 1)
+
+def to_micros(moment):
+    # Saat dilimsiz (UTC) datetime -> 1970'ten beri mikrosaniye
+    return (moment - UNIX_EPOCH) // timedelta(microseconds=1)
+
+def iso_to_micros(value):
+    moment = datetime.fromisoformat(value)
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+    return to_micros(moment)
+
+def micros_to_iso(ts):
+    return (UNIX_EPOCH + timedelta(microseconds=ts)).isoformat()
+
+class MessageRecord:
+    """
+    Bellekteki mesaj: dict yerine slot'lu bir nesne. Kanal ve yazar adları
+    intern edilir, zaman damgası tamsayı (mikrosaniye) tutulur, boş tepki
+    listesi None olarak saklanır. Mesajda hiç olmayan alanların slot'u boş
+    kalır (DM mesajlarında pinned ve reactions yoktur, channel_id None'dır).
+    Dışarıya (API, journal, snapshot) yalnızca to_dict() ile çıkar.
+    """
+
+    __slots__ = ('id', 'channel_id', 'author', 'content', 'ts', 'file_hash', 'pinned', 'reactions', 'extra')
+
+    FIELDS = ('id', 'channel_id', 'author', 'content', 'timestamp', 'file_hash', 'pinned', 'reactions')
+
+    @classmethod
+    def from_dict(cls, message):
+        r = cls()
+        r.id = message['id']
+        channel_id = message.get('channel_id')
+        r.channel_id = sys.intern(channel_id) if channel_id is not None else None
+        r.author = sys.intern(message['author'])
+        r.content = message['content']
+        r.ts = iso_to_micros(message['timestamp'])
+        # Bilinmeyen alanlar (ör. eski file_base64) olduğu gibi saklanır
+        r.extra = {k: v for k, v in message.items() if k not in cls.FIELDS} or None
+        if micros_to_iso(r.ts) != message['timestamp']:
+            # Farklı biçimde yazılmış zaman damgası aynen geri verilir
+            r.extra = dict(r.extra or {}, timestamp=message['timestamp'])
+        if 'file_hash' in message:
+            r.file_hash = message['file_hash']
+        if 'pinned' in message:
+            r.pinned = message['pinned']
+        if 'reactions' in message:
+            r.reactions = message['reactions'] or None
+        return r
+
+    def to_dict(self):
+        message = {"id": self.id}
+        if self.channel_id is not None:
+            message['channel_id'] = self.channel_id
+        message['author'] = self.author
+        message['content'] = self.content
+        message['timestamp'] = micros_to_iso(self.ts)
+        if hasattr(self, 'file_hash'):
+            message['file_hash'] = self.file_hash
+        if hasattr(self, 'pinned'):
+            message['pinned'] = self.pinned
+        if hasattr(self, 'reactions'):
+            message['reactions'] = [{"emoji_id": r['emoji_id'], "users": list(r['users'])}
+                                    for r in self.reactions or []]
+        if self.extra:
+            message.update(self.extra)
+        return message
+
+class MessageRef:
+    """
+    Snapshot'taki bir mesajın bellekteki yeri: gövde, source (bölüm
+    dosyasının mmap'i) içinde [offset, offset+length) aralığında durur ve
+    ancak okunduğunda parse edilir. Sıralama ve silme için id, ts ve
+    channel_id yeterlidir; gövde için JsonStore.load() kullanılır.
+    """
+
+    __slots__ = ('id', 'ts', 'channel_id', 'source', 'offset', 'length')
+
+    def __init__(self, entry, source, channel_id=None):
+        self.id, ts, self.offset, self.length = entry
+        # Eski snapshot'lar indekste ISO zaman damgası tutuyordu
+        self.ts = iso_to_micros(ts) if isinstance(ts, str) else ts
+        self.source = source
+        self.channel_id = channel_id
+
+class JsonStore:
+    """
+    Veritabanını bellekte tutar. Her değişiklik journal dosyasına tek satırlık
+    bir kayıt olarak eklenir; açılışta database.json okunur ve journal
+    sırayla tekrar oynatılır. Böylece bir yazma işleminin maliyeti
+    veritabanının boyutuna değil, değişikliğin boyutuna bağlıdır.
+
+    database.json bir snapshot'tır: snapshot_segment alanı, içerdiği son
+    journal segmentinin numarasını tutar. compact() aktif journal'ı
+    database.journal.<n> segmentine çevirir ve snapshot'ı yeniler; açılış
+    süresi tüm geçmişe değil, snapshot ile sonraki journal kuyruğuna bağlıdır.
+
+    Snapshot bölümlere ayrılır: database.json yalnızca kullanıcıları,
+    arkadaşlık isteklerini ve bölüm listesini tutar. Her sunucu (kanallar,
+    üyeler, roller, davetler, emojiler, audit log ve mesajlar) ve her DM
+    database.partitions/ altında kendi dosyasındadır: mesaj gövdeleri satır
+    satır, son satırda da bölümün üst verisi ve mesaj indeksi. Gövdeler
+    mmap ile gerektiğinde okunur; açılış süresi ve bellek kullanımı mesaj
+    geçmişinin boyutuna değil, üst veriye ve indekse bağlıdır. compact()
+    yalnızca son snapshot'tan bu yana değişen bölümleri yeniden yazar.
+    Eski biçimler (mesajları içine gömülü ya da tek mesaj dosyalı
+    database.json) de okunur; ilk compact() onları yeni biçime çevirir.
+    """
+
+    def __init__(self, db_path, journal_path, upto_segment=None):
+        """
+        upto_segment verilirse yalnızca okunur bir kopya açılır: snapshot'a
+        o numaraya kadarki segmentler uygulanır, aktif journal'a ve yazıcıya
+        dokunulmaz (compact() bunu kullanır).
+        """
+        self.db_path = db_path
+        self.journal_path = journal_path
+        # Salt okunur kopya, yeniden oynatılan op'ların dokunduğu bölümleri
+        # izler; save_snapshot() yalnızca onları yeniden yazar
+        self.tracking = upto_segment is not None
+        self.dirty = set()
+        self.compact_lock = threading.Lock()
+        self.last_compaction = None
+        if not os.path.exists(db_path):
+            save_db(empty_db(), db_path)
+        with open(db_path, 'r', encoding='utf-8') as f:
+            self.data = json.load(f)
+        self.segment = self.data.pop('snapshot_segment', 0)
+        self.build_indexes()
+        for n, path in self.segments():
+            if n > self.segment and (upto_segment is None or n <= upto_segment):
+                self.replay(path)
+        self.journal = None
+        if upto_segment is not None:
+            return
+        self.replay(journal_path)
+        self.journal = GroupCommitJournal(journal_path, GROUP_COMMIT_WINDOW, GROUP_COMMIT_MAX_OPS,
+                                          app.config['JOURNAL_DURABILITY'])
+        # relaxed modda kuyrukta kalan satırlar kapanışta diske indirilir
+        atexit.register(self.journal.close)
+
+    def build_indexes(self):
+        """
+        Birincil anahtar aramaları için sözlük indeksleri. Op'lar ekleme ve
+        silme sırasında bunları günceller, böylece aramalar O(1) olur.
+        """
+        message_index, dm_index = self.load_partitions()
+        self.users_by_name = {u['username']: u for u in self.data['users']}
+        self.guilds_by_id = {g['id']: g for g in self.data['guilds']}
+        self.dms_by_id = {dm['id']: dm for dm in self.data['direct_messages']}
+        for dm in self.data['direct_messages']:
+            if 'messages' in dm:
+                dm['messages'] = [MessageRecord.from_dict(m) for m in dm['messages']]
+            else:
+                dm['messages'] = dm_index.get(dm['id'], [])
+        self.dm_messages_by_id = {dm['id']: {m.id: m for m in dm['messages']}
+                                  for dm in self.data['direct_messages']}
+        # Mesajlar kanal başına zaman sırasıyla tutulur; düz liste yalnızca
+        # export() sırasında yeniden oluşturulur. Snapshot'tan gelenler
+        # MessageRef, sonradan eklenen ya da değişenler MessageRecord'dur.
+        self.messages_by_id = {}
+        self.messages_by_channel = message_index
+        for msgs in message_index.values():
+            for m in msgs:
+                self.messages_by_id[m.id] = m
+        for m in self.data.pop('messages', []):
+            self.insert_message(m)
+        self.invites_by_id = {}
+        self.channels_by_id = {}
+        self.emojis_by_id = {}
+        for g in self.data['guilds']:
+            for inv in g['invites']:
+                self.invites_by_id[inv['id']] = (g, inv)
+            for ch in g['channels']:
+                self.channels_by_id[ch['id']] = (g, ch)
+            for e in g['emojis']:
+                self.emojis_by_id[e['id']] = e
+
+    def snapshot_path(self, name):
+        return os.path.join(os.path.dirname(os.path.abspath(self.db_path)), name)
+
+    def map_file(self, name):
+        with open(self.snapshot_path(name), 'rb') as f:
+            if not os.fstat(f.fileno()).st_size:
+                return b''
+            # Dosya kapatılsa da eşleme açık kalır; compact() dosyayı
+            # silse bile eski gövdeler okunmaya devam eder
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def load_partitions(self):
+        """
+        Snapshot'taki bölüm dosyalarını açar; sunucuları ve DM'leri self.data'ya
+        ekler, mesaj indekslerini MessageRef listelerine çevirir:
+        ({channel_id: [ref]}, {dm_id: [ref]}).
+        """
+        message_index, dm_index = {}, {}
+        # (tür, id) -> bölüm dosyası; değişmeyen bölümler sonraki snapshot'ta aynen kalır
+        self.partition_files = {}
+        name = self.data.pop('messages_file', None)
+        if name:
+            # Tek mesaj dosyalı eski biçim
+            source = self.map_file(name)
+            for channel_id, entries in self.data.pop('message_index').items():
+                message_index[channel_id] = [MessageRef(e, source, channel_id) for e in entries]
+            for dm_id, entries in self.data.pop('dm_message_index').items():
+                dm_index[dm_id] = [MessageRef(e, source) for e in entries]
+        partitions = self.data.pop('partitions', None)
+        if partitions is None:
+            return message_index, dm_index
+        self.data['guilds'], self.data['direct_messages'] = [], []
+        for kind, name in partitions:
+            source = self.map_file(name)
+            # Son satır bölümün üst verisi ve indeksi
+            header = json.loads(source[source.rfind(b'\n', 0, len(source) - 1) + 1:])
+            if kind == 'guild':
+                guild = header['guild']
+                self.data['guilds'].append(guild)
+                for channel_id, entries in header['message_index'].items():
+                    message_index[channel_id] = [MessageRef(e, source, channel_id) for e in entries]
+                self.partition_files[('guild', guild['id'])] = name
+            else:
+                dm = header['dm']
+                self.data['direct_messages'].append(dm)
+                dm_index[dm['id']] = [MessageRef(e, source) for e in header['message_index'][dm['id']]]
+                self.partition_files[('dm', dm['id'])] = name
+        return message_index, dm_index
+
+    def load(self, m):
+        """Mesajın API'ye dönecek dict hali; MessageRef ise gövde dosyadan okunur."""
+        if isinstance(m, MessageRef):
+            return json.loads(m.source[m.offset:m.offset + m.length])
+        return m.to_dict()
+
+    def raw(self, m):
+        # Snapshot'a yazılacak satır; değişmemiş gövdeler parse edilmeden kopyalanır
+        if isinstance(m, MessageRef):
+            return m.source[m.offset:m.offset + m.length]
+        return json.dumps(m.to_dict(), ensure_ascii=False).encode('utf-8')
+
+    def materialize(self, msgs, by_id, message_id):
+        """
+        Değiştirilecek mesajı MessageRecord'a çevirip liste ve indekste yerine koyar.
+        """
+        m = by_id.get(message_id)
+        if isinstance(m, MessageRef):
+            full = MessageRecord.from_dict(self.load(m))
+            msgs[self.message_position(msgs, m)] = full
+            by_id[message_id] = full
+            m = full
+        return m
+
+    def hot_message(self, message_id):
+        m = self.messages_by_id.get(message_id)
+        if m is None:
+            return None
+        return self.materialize(self.messages_by_channel[m.channel_id], self.messages_by_id, message_id)
+
+    def hot_dm_message(self, dm_id, message_id):
+        if dm_id not in self.dms_by_id:
+            return None
+        return self.materialize(self.dms_by_id[dm_id]['messages'], self.dm_messages_by_id[dm_id], message_id)
+
+    def partitions_dir(self):
+        return os.path.splitext(os.path.basename(self.db_path))[0] + '.partitions'
+
+    def write_partition(self, name, header, groups):
+        """
+        groups: [(anahtar, mesaj listesi)]. Gövdeleri satır satır, ardından
+        header'ı (anahtar -> indeks girdileriyle) son satır olarak yazar.
+        """
+        path = self.snapshot_path(name)
+        offset = 0
+        index = {}
+        with open(path + '.tmp', 'wb') as f:
+            for key, msgs in groups:
+                entries = index[key] = []
+                for m in msgs:
+                    raw = self.raw(m)
+                    f.write(raw)
+                    f.write(b'\n')
+                    entries.append([m.id, m.ts, offset, len(raw)])
+                    offset += len(raw) + 1
+            header['message_index'] = index
+            f.write(json.dumps(header, ensure_ascii=False).encode('utf-8'))
+            f.write(b'\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+        fsync_dir(path)
+
+    def save_snapshot(self, segment):
+        """
+        Son snapshot'tan bu yana değişen (self.dirty) ya da henüz dosyası
+        olmayan bölümleri <sunucu|dm>-<id>.<segment> dosyalarına yazar, sonra
+        database.json'u atomik olarak değiştirir ve artık başvurulmayan bölüm
+        dosyalarını siler. Arada bir çökme eski snapshot'ı geçerli bırakır.
+        """
+        directory = self.partitions_dir()
+        os.makedirs(self.snapshot_path(directory), exist_ok=True)
+        partitions = []
+        for guild in self.data['guilds']:
+            name = self.partition_files.get(('guild', guild['id']))
+            if name is None or ('guild', guild['id']) in self.dirty:
+                name = f"{directory}/guild-{guild['id']}.{segment}"
+                self.write_partition(name, {"guild": guild},
+                                     [(ch['id'], self.messages_by_channel.get(ch['id'], []))
+                                      for ch in guild['channels']])
+            partitions.append(['guild', name])
+        for dm in self.data['direct_messages']:
+            name = self.partition_files.get(('dm', dm['id']))
+            if name is None or ('dm', dm['id']) in self.dirty:
+                name = f"{directory}/dm-{dm['id']}.{segment}"
+                self.write_partition(name, {"dm": {k: v for k, v in dm.items() if k != 'messages'}},
+                                     [(dm['id'], dm['messages'])])
+            partitions.append(['dm', name])
+        data = {k: v for k, v in self.data.items() if k not in ('guilds', 'direct_messages')}
+        # Hiçbir sunucuya ait olmayan kanallardaki mesajlar (eski verilerde
+        # olabilir) kaybolmasın diye ana dosyada düz liste olarak kalır
+        data['messages'] = [self.load(m) for channel_id, msgs in self.messages_by_channel.items()
+                            if channel_id not in self.channels_by_id for m in msgs]
+        data['snapshot_segment'] = segment
+        data['partitions'] = partitions
+        save_db(data, self.db_path)
+        keep = {self.snapshot_path(name) for _, name in partitions}
+        for name in os.listdir(self.snapshot_path(directory)):
+            path = self.snapshot_path(f'{directory}/{name}')
+            if path not in keep:
+                os.remove(path)
+        # Tek mesaj dosyalı eski biçimden kalanlar
+        prefix = os.path.splitext(os.path.basename(self.db_path))[0] + '.messages.'
+        for name in os.listdir(os.path.dirname(os.path.abspath(self.db_path))):
+            if name.startswith(prefix):
+                os.remove(self.snapshot_path(name))
+
+    def replay(self, path):
+        if not os.path.exists(path):
+            return
+        valid_size = 0
+        with open(path, 'rb') as f:
+            for raw in f:
+                try:
+                    record = json.loads(raw.decode('utf-8'))
+                except ValueError:
+                    # Yazılırken çöken son satır: atla ve dosyadan kes
+                    break
+                self.apply(record['op'], record['args'])
+                valid_size += len(raw)
+        if valid_size != os.path.getsize(path):
+            with open(path, 'r+b') as f:
+                f.truncate(valid_size)
+
+    def segments(self):
+        """Diskteki eski journal segmentleri, numara sırasıyla: [(n, yol)]."""
+        directory = os.path.dirname(os.path.abspath(self.journal_path))
+        prefix = os.path.basename(self.journal_path) + '.'
+        found = []
+        for name in os.listdir(directory):
+            suffix = name[len(prefix):]
+            if name.startswith(prefix) and suffix.isdigit():
+                found.append((int(suffix), os.path.join(directory, name)))
+        return sorted(found)
+
+    def compact(self):
+        """
+        Aktif journal'ı yeni bir segmente çevirir; ardından diskteki snapshot'ı
+        ayrı bir kopyaya yükleyip henüz içermediği segmentleri uygular, sonucu
+        atomik olarak yeni snapshot diye yazar ve artık gereksiz segmentleri
+        siler. Canlı veriye dokunulmaz; yazarlar yalnızca segment değişimi
+        süresince bekler. Araya giren bir çökmede segmentler diskte kalır ve
+        açılışta (ya da sonraki compact()'ta) yeniden oynatılır.
+        """
+        with self.compact_lock:
+            started = time.perf_counter()
+            last = max([self.segment] + [n for n, _ in self.segments()])
+            if self.journal.rotate(f'{self.journal_path}.{last + 1}'):
+                last += 1
+            if last == self.segment:
+                return False
+            JsonStore(self.db_path, self.journal_path, upto_segment=last).save_snapshot(last)
+            self.segment = last
+            for n, path in self.segments():
+                if n <= last:
+                    os.remove(path)
+            self.last_compaction = {"at": datetime.utcnow().isoformat(),
+                                    "segment": last,
+                                    "seconds": round(time.perf_counter() - started, 3)}
+            return True
+
+    def start_compaction(self):
+        """
+        Arka planda aktif journal'ı izler; SNAPSHOT_JOURNAL_BYTES aşılınca ya
+        da SNAPSHOT_INTERVAL dolunca ve journal boş değilse compact() çağırır.
+        """
+        def run():
+            last = time.monotonic()
+            while True:
+                time.sleep(min(SNAPSHOT_INTERVAL, 5))
+                size = self.journal.size()
+                if size >= SNAPSHOT_JOURNAL_BYTES or (size and time.monotonic() - last >= SNAPSHOT_INTERVAL):
+                    try:
+                        self.compact()
+                    except Exception:
+                        # Segmentler diskte kalır, bir sonraki turda yeniden denenir
+                        app.logger.exception("journal compaction failed")
+                    last = time.monotonic()
+
+        threading.Thread(target=run, name='journal-compaction', daemon=True).start()
+
+    def apply(self, op, args):
+        if self.tracking:
+            self.dirty.update(op_partitions(self, op, args))
+        return getattr(self, 'op_' + op)(**args)
+
+    def commit(self, op, args):
+        """
+        Çağıran, op'un bölüm kilitlerini tutar (bkz. commit()). Satır toplu
+        commit kuyruğuna eklenir; strict modda diske indikten sonra uygulanır.
+        Farklı bölümlere yazanlar aynı fsync'i paylaşır. Aynı bölümdeki op'lar
+        journal'a uygulandıkları sırayla girer; farklı bölümlerin op'ları
+        birbirinden bağımsız olduğundan yeniden oynatma sırası sonucu
+        değiştirmez.
+        """
+        line = json.dumps({"op": op, "args": args}, ensure_ascii=False)
+        self.journal.append(line)
+        return self.apply(op, args)
+
+    def stats(self):
+        return {"backend": "json", "journal": self.journal.stats(),
+                "journal_bytes": self.journal.size(), "snapshot_segment": self.segment,
+                "last_compaction": self.last_compaction}
+
+    # --- Okuma ---
+
+    def find_user(self, username):
+        return self.users_by_name.get(username)
+
+    def find_guild(self, guild_id):
+        return self.guilds_by_id.get(guild_id)
+
+    def guild_exists(self, guild_id):
+        return guild_id in self.guilds_by_id
+
+    def find_channel(self, channel_id):
+        return self.channels_by_id.get(channel_id, (None, None))
+
+    def channel_guild_id(self, channel_id):
+        guild, _ = self.find_channel(channel_id)
+        return guild['id'] if guild else None
+
+    def find_dm(self, dm_id):
+        return self.dms_by_id.get(dm_id)
+
+    def find_dm_between(self, user_a, user_b):
+        for dm in self.data['direct_messages']:
+            if set(dm['participants']) == set([user_a, user_b]):
+                return dm
+        return None
+
+    def find_invite(self, invite_id):
+        return self.invites_by_id.get(invite_id, (None, None))
+
+    def find_emoji(self, emoji_id):
+        return self.emojis_by_id.get(emoji_id)
+
+    def find_guild_emoji(self, guild_id, emoji_id):
+        guild = self.find_guild(guild_id)
+        return find_emoji(guild, emoji_id) if guild else None
+
+    def find_friend_request(self, request_id):
+        for fr in self.data['friend_requests']:
+            if fr['id'] == request_id:
+                return fr
+        return None
+
+    def friend_request_exists(self, from_user, to_user):
+        for fr in self.data['friend_requests']:
+            if fr['from'] == from_user and fr['to'] == to_user:
+                return True
+        return False
+
+    def incoming_friend_requests(self, username):
+        return [fr for fr in self.data['friend_requests'] if fr['to'] == username]
+
+    def user_summaries(self):
+        return ({
+            "username": u['username'],
+            "avatar_url": u['avatar_url']
+        } for u in self.data['users'])
+
+    def guild_summaries(self):
+        return ({
+            "id": g['id'],
+            "name": g['name'],
+            "owner": g['owner'],
+            "member_count": len(g['members'])
+        } for g in self.data['guilds'])
+
+    def audit_log_entries(self, guild_id):
+        guild = self.find_guild(guild_id)
+        return iter(guild['audit_logs'] if guild else ())
+
+    def find_message(self, message_id):
+        m = self.messages_by_id.get(message_id)
+        return self.load(m) if m is not None else None
+
+    def message_channel_id(self, message_id):
+        m = self.messages_by_id.get(message_id)
+        return m.channel_id if m is not None else None
+
+    def message_position(self, msgs, msg):
+        """
+        Mesajın listedeki yeri; yoksa None (kilitsiz okuyan paginate()
+        sırasında eşzamanlı olarak silinmiş olabilir).
+        """
+        i = bisect.bisect_left(msgs, msg.ts, key=lambda m: m.ts)
+        # Kimlik yerine id karşılaştırılır: materialize() bir MessageRef'i
+        # aynı id'li MessageRecord ile değiştirmiş olabilir
+        while i < len(msgs) and msgs[i].ts == msg.ts:
+            if msgs[i].id == msg.id:
+                return i
+            i += 1
+        return None
+
+    def paginate(self, msgs, by_id, limit, before, after):
+        """
+        Zaman sıralı bir mesaj listesinden imleçlere göre sayfa keser.
+        by_id yalnızca bu listeye ait mesajları içermelidir. Listede olmayan
+        bir snowflake imleç, içindeki zamana göre (milisaniye hassasiyetle)
+        konumlandırılır; böylece herhangi bir ana atlanabilir.
+        """
+        start, end = 0, len(msgs)
+        cursors = {}
+        for name, cursor in (('before', before), ('after', after)):
+            if cursor is not None:
+                m = by_id.get(cursor)
+                if m:
+                    position = self.message_position(msgs, m)
+                    if position is not None:
+                        cursors[name] = position
+                        continue
+                    # İmleç mesajı bu arada silindi: zamanına göre konumlanır
+                    moment = m.ts
+                else:
+                    moment = snowflake_datetime(cursor)
+                    if moment is None:
+                        return None
+                    moment = to_micros(moment)
+                if name == 'before':
+                    cursors[name] = bisect.bisect_left(msgs, moment, key=lambda m: m.ts)
+                else:
+                    cursors[name] = bisect.bisect_right(msgs, moment, key=lambda m: m.ts) - 1
+        if 'before' in cursors:
+            end = cursors['before']
+        if 'after' in cursors:
+            start = cursors['after'] + 1
+        if after is not None:
+            return msgs[start:min(end, start + limit)], start + limit < end
+        return msgs[max(start, end - limit):end], end - limit > start
+
+    def load_page(self, page):
+        if page is None:
+            return None
+        msgs, has_more = page
+        return [self.load(m) for m in msgs], has_more
+
+    def channel_messages(self, channel_id, limit, before=None, after=None):
+        by_id = {}
+        for cursor in (before, after):
+            m = self.messages_by_id.get(cursor)
+            if m and m.channel_id == channel_id:
+                by_id[cursor] = m
+        return self.load_page(self.paginate(self.messages_by_channel.get(channel_id, []), by_id,
+                                            limit, before, after))
+
+    def find_dm_message(self, dm_id, message_id):
+        m = self.dm_messages_by_id.get(dm_id, {}).get(message_id)
+        return self.load(m) if m is not None else None
+
+    def dm_messages(self, dm_id, limit, before=None, after=None):
+        return self.load_page(self.paginate(self.find_dm(dm_id)['messages'], self.dm_messages_by_id[dm_id],
+                                            limit, before, after))
+
+    def iter_messages(self):
+        # Gövdeler tek tek çözülür; tüm geçmiş aynı anda belleğe alınmaz.
+        # Anahtarların kopyası üzerinde dönülür, arada silinenler atlanır.
+        for message_id in list(self.messages_by_id):
+            m = self.messages_by_id.get(message_id)
+            if m is not None:
+                yield self.load(m)
+
+    def inline_attachments(self):
+        """
+        Hâlâ file_base64 taşıyan mesajlar: (dm_id veya None, message_id, file_base64).
+        """
+        found = [(None, m['id'], m['file_base64'])
+                 for m in self.iter_messages() if m.get('file_base64')]
+        for dm_id, msgs in self.dm_messages_by_id.items():
+            found += [(dm_id, m['id'], m['file_base64'])
+                      for m in map(self.load, msgs.values()) if m.get('file_base64')]
+        return found
+
+    def inline_emojis(self):
+        """
+        Görseli hâlâ image_base64 olarak tutulan emojiler: (guild_id, emoji_id, image_base64).
+        """
+        return [(g['id'], e['id'], e['image_base64'])
+                for g in self.data['guilds'] for e in g['emojis'] if e.get('image_base64')]
+
+    def export(self):
+        """
+        database.json biçiminde bir görünüm: mesajlar zaman sırasıyla tek listede.
+        """
+        data = dict(self.data)
+        data['direct_messages'] = [dict(dm, messages=[self.load(m) for m in dm['messages']])
+                                   for dm in self.data['direct_messages']]
+        data['messages'] = [self.load(m) for m in heapq.merge(*self.messages_by_channel.values(),
+                                                              key=lambda m: m.ts)]
+        return data
+
+    # --- Kullanıcılar ---
+
+    def op_add_user(self, user):
+        if user['username'] in self.users_by_name:
+            return False
+        self.data['users'].append(user)
+        self.users_by_name[user['username']] = user
+        return True
+
+    def op_update_user(self, username, fields):
+        user = self.find_user(username)
+        if user:
+            user.update(fields)
+
+    def op_add_friendship(self, user_a, user_b):
+        a = self.find_user(user_a)
+        b = self.find_user(user_b)
+        if not a or not b:
+            return
+        if user_b not in a['friends']:
+            a['friends'].append(user_b)
+        if user_a not in b['friends']:
+            b['friends'].append(user_a)
+
+    def op_add_user_guild(self, username, guild_id):
+        user = self.find_user(username)
+        if user and guild_id not in user['guilds']:
+            user['guilds'].append(guild_id)
+
+    def op_remove_user_guild(self, username, guild_id):
+        user = self.find_user(username)
+        if user and guild_id in user['guilds']:
+            user['guilds'].remove(guild_id)
+
+    def op_add_user_dm(self, username, dm_id):
+        user = self.find_user(username)
+        if user and dm_id not in user['dm_channels']:
+            user['dm_channels'].append(dm_id)
+
+    # --- Arkadaşlık istekleri ---
+
+    def op_add_friend_request(self, request):
+        if self.friend_request_exists(request['from'], request['to']):
+            return False
+        self.data['friend_requests'].append(request)
+        return True
+
+    def op_remove_friend_request(self, request_id):
+        self.data['friend_requests'] = [
+            fr for fr in self.data['friend_requests'] if fr['id'] != request_id
+        ]
+
+    # --- DM ---
+
+    def op_add_dm(self, dm):
+        self.data['direct_messages'].append(dm)
+        dm['messages'] = [MessageRecord.from_dict(m) for m in dm['messages']]
+        self.dms_by_id[dm['id']] = dm
+        self.dm_messages_by_id[dm['id']] = {m.id: m for m in dm['messages']}
+
+    def op_add_dm_message(self, dm_id, message):
+        message = MessageRecord.from_dict(message)
+        msgs = self.find_dm(dm_id)['messages']
+        if msgs and msgs[-1].ts > message.ts:
+            bisect.insort_right(msgs, message, key=lambda m: m.ts)
+        else:
+            msgs.append(message)
+        self.dm_messages_by_id[dm_id][message.id] = message
+
+    def op_edit_dm_message(self, dm_id, message_id, content):
+        msg = self.hot_dm_message(dm_id, message_id)
+        if msg:
+            msg.content = content
+
+    def op_set_dm_message_file(self, dm_id, message_id, file_hash):
+        msg = self.hot_dm_message(dm_id, message_id)
+        if msg:
+            self.set_file(msg, file_hash)
+
+    def op_delete_dm_message(self, dm_id, message_id):
+        msg = self.dm_messages_by_id[dm_id].pop(message_id, None)
+        if msg:
+            msgs = self.find_dm(dm_id)['messages']
+            del msgs[self.message_position(msgs, msg)]
+
+    # --- Sunucular ---
+
+    def op_add_guild(self, guild):
+        self.data['guilds'].append(guild)
+        self.guilds_by_id[guild['id']] = guild
+        for inv in guild['invites']:
+            self.invites_by_id[inv['id']] = (guild, inv)
+        for ch in guild['channels']:
+            self.channels_by_id[ch['id']] = (guild, ch)
+        for e in guild['emojis']:
+            self.emojis_by_id[e['id']] = e
+
+    def op_add_audit_log(self, guild_id, entry):
+        self.find_guild(guild_id)['audit_logs'].append(entry)
+
+    def op_add_category(self, guild_id, category):
+        self.find_guild(guild_id)['categories'].append(category)
+
+    def op_add_channel(self, guild_id, channel):
+        guild = self.find_guild(guild_id)
+        guild['channels'].append(channel)
+        self.channels_by_id[channel['id']] = (guild, channel)
+
+    # Ses oturumları artık VoiceStateManager'da; aşağıdaki üç op yalnızca
+    # eski journal kayıtları yeniden oynatılabilsin diye duruyor.
+    def op_add_voice_user(self, guild_id, channel_id, username):
+        _, ch = self.find_channel(channel_id)
+        if username not in ch['connected_users']:
+            ch['connected_users'].append(username)
+
+    def op_remove_voice_user(self, guild_id, channel_id, username):
+        _, ch = self.find_channel(channel_id)
+        if username in ch['connected_users']:
+            ch['connected_users'].remove(username)
+
+    def op_set_screen_share(self, guild_id, channel_id, screen_share):
+        _, ch = self.find_channel(channel_id)
+        ch['screen_share'] = screen_share
+
+    def op_add_invite(self, guild_id, invite):
+        guild = self.find_guild(guild_id)
+        guild['invites'].append(invite)
+        self.invites_by_id[invite['id']] = (guild, invite)
+
+    def op_use_invite(self, guild_id, invite_id):
+        _, inv = self.find_invite(invite_id)
+        if inv:
+            inv['uses'] += 1
+
+    def op_add_member(self, guild_id, member):
+        guild = self.find_guild(guild_id)
+        if not user_in_guild(guild, member['username']):
+            guild['members'].append(member)
+
+    def op_remove_member(self, guild_id, username):
+        guild = self.find_guild(guild_id)
+        guild['members'] = [m for m in guild['members'] if m['username'] != username]
+
+    def op_add_ban(self, guild_id, username):
+        guild = self.find_guild(guild_id)
+        if 'bans' not in guild:
+            guild['bans'] = []
+        if username not in guild['bans']:
+            guild['bans'].append(username)
+
+    def op_remove_ban(self, guild_id, username):
+        guild = self.find_guild(guild_id)
+        if username in guild.get('bans', []):
+            guild['bans'].remove(username)
+
+    def op_add_emoji(self, guild_id, emoji):
+        self.find_guild(guild_id)['emojis'].append(emoji)
+        self.emojis_by_id[emoji['id']] = emoji
+
+    def op_set_emoji_image(self, guild_id, emoji_id, image_hash):
+        emoji = self.find_emoji(emoji_id)
+        if emoji:
+            emoji.pop('image_base64', None)
+            emoji['image_hash'] = image_hash
+
+    def op_remove_emoji(self, guild_id, emoji_id):
+        guild = self.find_guild(guild_id)
+        guild['emojis'] = [e for e in guild['emojis'] if e['id'] != emoji_id]
+        self.emojis_by_id.pop(emoji_id, None)
+
+    # --- Sunucu mesajları ---
+
+    def insert_message(self, message):
+        message = MessageRecord.from_dict(message)
+        msgs = self.messages_by_channel.setdefault(message.channel_id, [])
+        if msgs and msgs[-1].ts > message.ts:
+            bisect.insort_right(msgs, message, key=lambda m: m.ts)
+        else:
+            msgs.append(message)
+        self.messages_by_id[message.id] = message
+
+    def set_file(self, msg, file_hash):
+        if msg.extra:
+            msg.extra.pop('file_base64', None)
+            msg.extra = msg.extra or None
+        msg.file_hash = file_hash
+
+    def op_add_message(self, message):
+        self.insert_message(message)
+
+    def op_edit_message(self, message_id, content):
+        msg = self.hot_message(message_id)
+        if msg:
+            msg.content = content
+
+    def op_set_message_file(self, message_id, file_hash):
+        msg = self.hot_message(message_id)
+        if msg:
+            self.set_file(msg, file_hash)
+
+    def op_delete_message(self, message_id):
+        msg = self.messages_by_id.pop(message_id, None)
+        if msg:
+            msgs = self.messages_by_channel[msg.channel_id]
+            del msgs[self.message_position(msgs, msg)]
+
+    def op_pin_message(self, message_id):
+        msg = self.hot_message(message_id)
+        if msg:
+            msg.pinned = True
+
+    def op_add_reaction(self, message_id, emoji_id, username):
+        msg = self.hot_message(message_id)
+        if not msg:
+            return
+        reactions = getattr(msg, 'reactions', None) or []
+        msg.reactions = reactions
+        for r in reactions:
+            if r['emoji_id'] == emoji_id:
+                if username not in r['users']:
+                    r['users'].append(username)
+                return
+        reactions.append({"emoji_id": emoji_id, "users": [username]})
+
+    def op_remove_reaction(self, message_id, emoji_id, username):
+        msg = self.hot_message(message_id)
+        if not msg:
+            return
+        for r in getattr(msg, 'reactions', None) or []:
+            if r['emoji_id'] == emoji_id:
+                if username in r['users']:
+                    r['users'].remove(username)
+                if len(r['users']) == 0:
+                    msg.reactions.remove(r)
+                    msg.reactions = msg.reactions or None
+                return
+
+##########################
+# SQLite Depolama        #
+##########################
+
+class SqliteStore:
+    """
+    JsonStore ile aynı okuma ve yazma arayüzünü SQLite üzerinde sunar.
+    Her değişiklik tek bir transaction içinde yalnızca ilgili satırları
+    günceller; aramalar birincil anahtarlar ve indeksler üzerinden yapılır.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            username TEXT PRIMARY KEY,
+            password TEXT,
+            online INTEGER NOT NULL DEFAULT 0,
+            avatar_url TEXT,
+            banner_url TEXT
+        );
+        CREATE TABLE IF NOT EXISTS friendships (
+            username TEXT NOT NULL,
+            friend TEXT NOT NULL,
+            PRIMARY KEY (username, friend)
+        );
+        CREATE TABLE IF NOT EXISTS user_guilds (
+            username TEXT NOT NULL,
+            guild_id TEXT NOT NULL,
+            PRIMARY KEY (username, guild_id)
+        );
+        CREATE TABLE IF NOT EXISTS user_dms (
+            username TEXT NOT NULL,
+            dm_id TEXT NOT NULL,
+            PRIMARY KEY (username, dm_id)
+        );
+        CREATE TABLE IF NOT EXISTS friend_requests (
+            id TEXT PRIMARY KEY,
+            from_user TEXT NOT NULL,
+            to_user TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_friend_requests_to ON friend_requests (to_user);
+        CREATE INDEX IF NOT EXISTS idx_friend_requests_pair ON friend_requests (from_user, to_user);
+
+        CREATE TABLE IF NOT EXISTS guilds (
+            id TEXT PRIMARY KEY,
+            name TEXT,
+            owner TEXT
+        );
+        CREATE TABLE IF NOT EXISTS roles (
+            id TEXT PRIMARY KEY,
+            guild_id TEXT NOT NULL,
+            name TEXT NOT NULL,
+            permissions TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_roles_guild ON roles (guild_id);
+        CREATE TABLE IF NOT EXISTS members (
+            guild_id TEXT NOT NULL,
+            username TEXT NOT NULL,
+            roles TEXT NOT NULL,
+            joined_at TEXT,
+            PRIMARY KEY (guild_id, username)
+        );
+        CREATE TABLE IF NOT EXISTS categories (
+            id TEXT PRIMARY KEY,
+            guild_id TEXT NOT NULL,
+            name TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_categories_guild ON categories (guild_id);
+        CREATE TABLE IF NOT EXISTS channels (
+            id TEXT PRIMARY KEY,
+            guild_id TEXT NOT NULL,
+            category_id TEXT,
+            name TEXT,
+            description TEXT,
+            type TEXT NOT NULL DEFAULT 'text',
+            is_private INTEGER NOT NULL DEFAULT 0,
+            allowed_roles TEXT NOT NULL DEFAULT '[]',
+            connected_users TEXT,
+            screen_share TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_channels_guild ON channels (guild_id);
+        CREATE TABLE IF NOT EXISTS invites (
+            id TEXT PRIMARY KEY,
+            guild_id TEXT NOT NULL,
+            channel_id TEXT,
+            created_by TEXT,
+            expires_at TEXT,
+            uses INTEGER NOT NULL DEFAULT 0,
+            max_uses INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS idx_invites_guild ON invites (guild_id);
+        CREATE TABLE IF NOT EXISTS emojis (
+            id TEXT PRIMARY KEY,
+            guild_id TEXT NOT NULL,
+            name TEXT,
+            image_base64 TEXT,
+            image_hash TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_emojis_guild ON emojis (guild_id);
+        CREATE TABLE IF NOT EXISTS bans (
+            guild_id TEXT NOT NULL,
+            username TEXT NOT NULL,
+            PRIMARY KEY (guild_id, username)
+        );
+        CREATE TABLE IF NOT EXISTS audit_logs (
+            id TEXT PRIMARY KEY,
+            guild_id TEXT NOT NULL,
+            action TEXT,
+            user TEXT,
+            timestamp TEXT,
+            details TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_audit_logs_guild ON audit_logs (guild_id, timestamp);
+
+        CREATE TABLE IF NOT EXISTS messages (
+            id TEXT PRIMARY KEY,
+            channel_id TEXT NOT NULL,
+            author TEXT NOT NULL,
+            content TEXT,
+            timestamp TEXT NOT NULL,
+            file_base64 TEXT,
+            pinned INTEGER NOT NULL DEFAULT 0,
+            file_hash TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_messages_channel_ts ON messages (channel_id, timestamp);
+        CREATE INDEX IF NOT EXISTS idx_messages_author ON messages (author);
+        CREATE TABLE IF NOT EXISTS reactions (
+            message_id TEXT NOT NULL,
+            emoji_id TEXT NOT NULL,
+            username TEXT NOT NULL,
+            PRIMARY KEY (message_id, emoji_id, username)
+        );
+
+        CREATE TABLE IF NOT EXISTS dms (
+            id TEXT PRIMARY KEY
+        );
+        CREATE TABLE IF NOT EXISTS dm_participants (
+            dm_id TEXT NOT NULL,
+            username TEXT NOT NULL,
+            PRIMARY KEY (dm_id, username)
+        );
+        CREATE INDEX IF NOT EXISTS idx_dm_participants_user ON dm_participants (username);
+        CREATE TABLE IF NOT EXISTS dm_messages (
+            id TEXT PRIMARY KEY,
+            dm_id TEXT NOT NULL,
+            author TEXT NOT NULL,
+            content TEXT,
+            timestamp TEXT NOT NULL,
+            file_base64 TEXT,
+            file_hash TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_dm_messages_dm_ts ON dm_messages (dm_id, timestamp);
+    """
+
+    USER_COLUMNS = ('password', 'online', 'avatar_url', 'banner_url')
+    ADDED_COLUMNS = (('messages', 'file_hash'), ('dm_messages', 'file_hash'), ('emojis', 'image_hash'))
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.conn().executescript(self.SCHEMA)
+        # Blob deposundan önce oluşturulmuş veritabanlarına yeni sütunlar eklenir
+        for table, column in self.ADDED_COLUMNS:
+            if column not in self.column('SELECT name FROM pragma_table_info(?)', (table,)):
+                self.conn().execute(f'ALTER TABLE {table} ADD COLUMN {column} TEXT')
+
+    def conn(self):
+        # sqlite3 bağlantıları thread'ler arasında paylaşılmaz
+        c = getattr(self.local, 'conn', None)
+        if c is None:
+            c = sqlite3.connect(self.path)
+            c.row_factory = sqlite3.Row
+            c.execute('PRAGMA journal_mode=WAL')
+            # relaxed: WAL'a yazılan commit fsync beklemez, checkpoint'te diske iner
+            c.execute('PRAGMA synchronous=' + self.synchronous())
+            self.local.conn = c
+        return c
+
+    def apply(self, op, args):
+        return getattr(self, 'op_' + op)(**args)
+
+    def commit(self, op, args):
+        # SQLite aynı anda tek yazara izin verir; bölüm kilitleri burada
+        # yalnızca rotaların kontrol-yaz adımlarını korur
+        with self.lock:
+            with self.conn():
+                return self.apply(op, args)
+
+    def synchronous(self):
+        return 'NORMAL' if app.config['JOURNAL_DURABILITY'] == 'relaxed' else 'FULL'
+
+    def stats(self):
+        return {"backend": "sqlite", "durability": app.config['JOURNAL_DURABILITY'],
+                "synchronous": self.synchronous()}
+
+    @contextmanager
+    def snapshot(self):
+        """
+        Birden çok SELECT'ten oluşan okumaları tek bir WAL anlık görüntüsünde
+        çalıştırır; arada commit edilen bir yazı dokümanı yarım göstermez.
+        """
+        c = self.conn()
+        if c.in_transaction:
+            yield c
+            return
+        c.execute('BEGIN')
+        try:
+            yield c
+        finally:
+            c.commit()
+
+    def column(self, sql, params=()):
+        return [r[0] for r in self.conn().execute(sql, params)]
+
+    # --- Satır -> doküman ---
+
+    def user_doc(self, row):
+        username = row['username']
+        user = {
+            "username": username,
+            "password": row['password'],
+            "online": bool(row['online']),
+            "friends": self.column('SELECT friend FROM friendships WHERE username=? ORDER BY rowid', (username,)),
+            "guilds": self.column('SELECT guild_id FROM user_guilds WHERE username=? ORDER BY rowid', (username,)),
+            "dm_channels": self.column('SELECT dm_id FROM user_dms WHERE username=? ORDER BY rowid', (username,)),
+            "avatar_url": row['avatar_url']
+        }
+        if row['banner_url'] is not None:
+            user['banner_url'] = row['banner_url']
+        return user
+
+    def channel_doc(self, row):
+        ch = {
+            "id": row['id'],
+            "guild_id": row['guild_id'],
+            "name": row['name'],
+            "type": row['type'],
+            "is_private": bool(row['is_private']),
+            "allowed_roles": json.loads(row['allowed_roles'])
+        }
+        if row['type'] == 'voice':
+            ch['connected_users'] = json.loads(row['connected_users'] or '[]')
+            ch['screen_share'] = json.loads(row['screen_share'] or '{"active": false, "user": null}')
+        else:
+            ch['category_id'] = row['category_id']
+            ch['description'] = row['description']
+        return ch
+
+    def guild_core_doc(self, row):
+        """
+        Yetki ve üyelik kontrolleri için gereken alanlar (rol, üye, yasak).
+        Kanal ve davetiye aramaları bunu döndürür; geçmişle büyüyen denetim
+        kayıtları, davetiyeler ve emojiler her istekte okunmaz.
+        """
+        c = self.conn()
+        gid = row['id']
+        return {
+            "id": gid,
+            "name": row['name'],
+            "owner": row['owner'],
+            "roles": [{
+                "id": r['id'],
+                "name": r['name'],
+                "permissions": json.loads(r['permissions'])
+            } for r in c.execute('SELECT * FROM roles WHERE guild_id=? ORDER BY rowid', (gid,))],
+            "members": [{
+                "username": r['username'],
+                "roles": json.loads(r['roles']),
+                "joined_at": r['joined_at']
+            } for r in c.execute('SELECT * FROM members WHERE guild_id=? ORDER BY rowid', (gid,))],
+            "bans": self.column('SELECT username FROM bans WHERE guild_id=? ORDER BY rowid', (gid,))
+        }
+
+    def guild_doc(self, row):
+        c = self.conn()
+        gid = row['id']
+        guild = self.guild_core_doc(row)
+        bans = guild.pop('bans')
+        return {
+            **guild,
+            "categories": [{
+                "id": r['id'],
+                "name": r['name']
+            } for r in c.execute('SELECT * FROM categories WHERE guild_id=? ORDER BY rowid', (gid,))],
+            "channels": [self.channel_doc(r)
+                         for r in c.execute('SELECT * FROM channels WHERE guild_id=? ORDER BY rowid', (gid,))],
+            "invites": [self.invite_doc(r)
+                        for r in c.execute('SELECT * FROM invites WHERE guild_id=? ORDER BY rowid', (gid,))],
+            "emojis": [self.emoji_doc(r)
+                       for r in c.execute('SELECT * FROM emojis WHERE guild_id=? ORDER BY rowid', (gid,))],
+            "audit_logs": [{
+                "id": r['id'],
+                "action": r['action'],
+                "user": r['user'],
+                "timestamp": r['timestamp'],
+                "details": r['details']
+            } for r in c.execute('SELECT * FROM audit_logs WHERE guild_id=? ORDER BY rowid', (gid,))],
+            "bans": bans
+        }
+
+    def attachment_fields(self, doc, row):
+        # Taşınmamış eski mesajlar file_base64, yeniler file_hash taşır
+        if row['file_base64'] is not None:
+            doc['file_base64'] = row['file_base64']
+        else:
+            doc['file_hash'] = row['file_hash']
+        return doc
+
+    def invite_doc(self, row):
+        return {
+            "id": row['id'],
+            "channel_id": row['channel_id'],
+            "created_by": row['created_by'],
+            "expires_at": row['expires_at'],
+            "uses": row['uses'],
+            "max_uses": row['max_uses']
+        }
+
+    def emoji_doc(self, row):
+        emoji = {"id": row['id'], "name": row['name']}
+        if row['image_base64'] is not None:
+            emoji['image_base64'] = row['image_base64']
+        else:
+            emoji['image_hash'] = row['image_hash']
+        return emoji
+
+    def message_docs(self, rows):
+        """
+        Mesaj satırlarını tepkileriyle birlikte dokümana çevirir (tek sorguda).
+        """
+        msgs = [self.attachment_fields({
+            "id": r['id'],
+            "channel_id": r['channel_id'],
+            "author": r['author'],
+            "content": r['content'],
+            "timestamp": r['timestamp'],
+            "pinned": bool(r['pinned']),
+            "reactions": []
+        }, r) for r in rows]
+        if not msgs:
+            return msgs
+        by_id = {m['id']: m for m in msgs}
+        groups = {}
+        placeholders = ','.join('?' * len(by_id))
+        for r in self.conn().execute(
+                f'SELECT * FROM reactions WHERE message_id IN ({placeholders}) ORDER BY rowid',
+                list(by_id)):
+            key = (r['message_id'], r['emoji_id'])
+            if key not in groups:
+                groups[key] = {"emoji_id": r['emoji_id'], "users": []}
+                by_id[r['message_id']]['reactions'].append(groups[key])
+            groups[key]['users'].append(r['username'])
+        return msgs
+
+    def dm_message_doc(self, row):
+        return self.attachment_fields({
+            "id": row['id'],
+            "author": row['author'],
+            "content": row['content'],
+            "timestamp": row['timestamp']
+        }, row)
+
+    # --- Okuma ---
+
+    def find_user(self, username):
+        with self.snapshot() as c:
+            row = c.execute('SELECT * FROM users WHERE username=?', (username,)).fetchone()
+            return self.user_doc(row) if row else None
+
+    def find_guild(self, guild_id):
+        with self.snapshot() as c:
+            row = c.execute('SELECT * FROM guilds WHERE id=?', (guild_id,)).fetchone()
+            return self.guild_doc(row) if row else None
+
+    def guild_exists(self, guild_id):
+        return self.conn().execute('SELECT 1 FROM guilds WHERE id=?', (guild_id,)).fetchone() is not None
+
+    def channel_guild_id(self, channel_id):
+        row = self.conn().execute('SELECT guild_id FROM channels WHERE id=?', (channel_id,)).fetchone()
+        return row['guild_id'] if row else None
+
+    def find_channel(self, channel_id):
+        with self.snapshot() as c:
+            row = c.execute('SELECT * FROM channels WHERE id=?', (channel_id,)).fetchone()
+            if not row:
+                return None, None
+            guild = c.execute('SELECT * FROM guilds WHERE id=?', (row['guild_id'],)).fetchone()
+            return self.guild_core_doc(guild), self.channel_doc(row)
+
+    def find_dm(self, dm_id):
+        """
+        DM'in id ve katılımcıları; mesajlar dm_messages() ile sayfa sayfa okunur.
+        """
+        row = self.conn().execute('SELECT id FROM dms WHERE id=?', (dm_id,)).fetchone()
+        if not row:
+            return None
+        return {
+            "id": dm_id,
+            "participants": self.column(
+                'SELECT username FROM dm_participants WHERE dm_id=? ORDER BY rowid', (dm_id,))
+        }
+
+    def find_dm_message(self, dm_id, message_id):
+        row = self.conn().execute('SELECT * FROM dm_messages WHERE id=? AND dm_id=?',
+                                  (message_id, dm_id)).fetchone()
+        return self.dm_message_doc(row) if row else None
+
+    def dm_messages(self, dm_id, limit, before=None, after=None):
+        page = self.page_rows('dm_messages', 'dm_id', dm_id, limit, before, after)
+        if page is None:
+            return None
+        rows, has_more = page
+        return [self.dm_message_doc(r) for r in rows], has_more
+
+    def find_dm_between(self, user_a, user_b):
+        ids = self.column(
+            'SELECT dm_id FROM dm_participants WHERE username=? '
+            'INTERSECT SELECT dm_id FROM dm_participants WHERE username=?', (user_a, user_b))
+        return self.find_dm(ids[0]) if ids else None
+
+    def find_emoji(self, emoji_id):
+        row = self.conn().execute('SELECT * FROM emojis WHERE id=?', (emoji_id,)).fetchone()
+        return self.emoji_doc(row) if row else None
+
+    def find_invite(self, invite_id):
+        with self.snapshot() as c:
+            row = c.execute('SELECT * FROM invites WHERE id=?', (invite_id,)).fetchone()
+            if not row:
+                return None, None
+            guild = c.execute('SELECT * FROM guilds WHERE id=?', (row['guild_id'],)).fetchone()
+            return self.guild_core_doc(guild), self.invite_doc(row)
+
+    def find_guild_emoji(self, guild_id, emoji_id):
+        row = self.conn().execute('SELECT * FROM emojis WHERE id=? AND guild_id=?',
+                                  (emoji_id, guild_id)).fetchone()
+        return self.emoji_doc(row) if row else None
+
+    def find_friend_request(self, request_id):
+        row = self.conn().execute('SELECT * FROM friend_requests WHERE id=?', (request_id,)).fetchone()
+        if not row:
+            return None
+        return {"id": row['id'], "from": row['from_user'], "to": row['to_user']}
+
+    def friend_request_exists(self, from_user, to_user):
+        row = self.conn().execute('SELECT 1 FROM friend_requests WHERE from_user=? AND to_user=?',
+                                  (from_user, to_user)).fetchone()
+        return row is not None
+
+    def incoming_friend_requests(self, username):
+        return [{"id": r['id'], "from": r['from_user'], "to": r['to_user']}
+                for r in self.conn().execute(
+                    'SELECT * FROM friend_requests WHERE to_user=? ORDER BY rowid', (username,))]
+
+    def user_summaries(self):
+        # Satırlar cursor'dan okundukça üretilir; tüm tablo belleğe alınmaz
+        return ({
+            "username": r['username'],
+            "avatar_url": r['avatar_url']
+        } for r in self.conn().execute('SELECT username, avatar_url FROM users ORDER BY rowid'))
+
+    def guild_summaries(self):
+        return ({
+            "id": r['id'],
+            "name": r['name'],
+            "owner": r['owner'],
+            "member_count": r['member_count']
+        } for r in self.conn().execute(
+            'SELECT g.id, g.name, g.owner, '
+            '(SELECT COUNT(*) FROM members m WHERE m.guild_id = g.id) AS member_count '
+            'FROM guilds g ORDER BY g.rowid'))
+
+    def audit_log_entries(self, guild_id):
+        # Üreteç fonksiyonu: sorgu ilk kayıt istendiğinde çalışır
+        for r in self.conn().execute('SELECT * FROM audit_logs WHERE guild_id=? ORDER BY rowid', (guild_id,)):
+            yield {
+                "id": r['id'],
+                "action": r['action'],
+                "user": r['user'],
+                "timestamp": r['timestamp'],
+                "details": r['details']
+            }
+
+    def find_message(self, message_id):
+        rows = self.conn().execute('SELECT * FROM messages WHERE id=?', (message_id,)).fetchall()
+        msgs = self.message_docs(rows)
+        return msgs[0] if msgs else None
+
+    def message_channel_id(self, message_id):
+        row = self.conn().execute('SELECT channel_id FROM messages WHERE id=?', (message_id,)).fetchone()
+        return row['channel_id'] if row else None
+
+    def page_rows(self, table, key_column, key, limit, before, after):
+        """
+        (key_column, timestamp) indeksi üzerinden imleçli sayfa okur.
+        Tabloda olmayan bir snowflake imleç, içindeki zamana göre uygulanır.
+        """
+        c = self.conn()
+        where = [f'{key_column}=?']
+        params = [key]
+        for cursor, op in ((before, '<'), (after, '>')):
+            if cursor is None:
+                continue
+            row = c.execute(f'SELECT timestamp, rowid FROM {table} WHERE id=? AND {key_column}=?',
+                            (cursor, key)).fetchone()
+            if not row:
+                moment = snowflake_datetime(cursor)
+                if moment is None:
+                    return None
+                where.append(f'timestamp {op} ?')
+                params.append(moment.isoformat())
+                continue
+            where.append(f'(timestamp, rowid) {op} (?, ?)')
+            params += [row[0], row[1]]
+        order = 'ASC' if after is not None else 'DESC'
+        rows = c.execute(
+            f'SELECT * FROM {table} WHERE {" AND ".join(where)} '
+            f'ORDER BY timestamp {order}, rowid {order} LIMIT ?', params + [limit + 1]).fetchall()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if after is None:
+            rows.reverse()
+        return rows, has_more
+
+    def channel_messages(self, channel_id, limit, before=None, after=None):
+        page = self.page_rows('messages', 'channel_id', channel_id, limit, before, after)
+        if page is None:
+            return None
+        rows, has_more = page
+        return self.message_docs(rows), has_more
+
+    def iter_messages(self):
+        return self.conn().execute('SELECT id, channel_id, author, content, timestamp FROM messages')
+
+    def inline_attachments(self):
+        c = self.conn()
+        found = [(None, r[0], r[1]) for r in c.execute(
+            'SELECT id, file_base64 FROM messages WHERE file_base64 IS NOT NULL AND file_hash IS NULL')]
+        found += [tuple(r) for r in c.execute(
+            'SELECT dm_id, id, file_base64 FROM dm_messages WHERE file_base64 IS NOT NULL AND file_hash IS NULL')]
+        return found
+
+    def inline_emojis(self):
+        return [tuple(r) for r in self.conn().execute(
+            'SELECT guild_id, id, image_base64 FROM emojis WHERE image_base64 IS NOT NULL AND image_hash IS NULL')]
+
+    # --- Kullanıcılar ---
+
+    def op_add_user(self, user):
+        c = self.conn()
+        if c.execute('SELECT 1 FROM users WHERE username=?', (user['username'],)).fetchone():
+            return False
+        c.execute('INSERT INTO users (username, password, online, avatar_url, banner_url) VALUES (?,?,?,?,?)',
+                  (user['username'], user.get('password'), bool(user.get('online')),
+                   user.get('avatar_url'), user.get('banner_url')))
+        for f in user.get('friends', []):
+            c.execute('INSERT OR IGNORE INTO friendships (username, friend) VALUES (?,?)', (user['username'], f))
+        for gid in user.get('guilds', []):
+            self.op_add_user_guild(user['username'], gid)
+        for dm_id in user.get('dm_channels', []):
+            self.op_add_user_dm(user['username'], dm_id)
+        return True
+
+    def op_update_user(self, username, fields):
+        for key, value in fields.items():
+            if key in self.USER_COLUMNS:
+                self.conn().execute(f'UPDATE users SET {key}=? WHERE username=?', (value, username))
+
+    def op_add_friendship(self, user_a, user_b):
+        c = self.conn()
+        c.execute('INSERT OR IGNORE INTO friendships (username, friend) VALUES (?,?)', (user_a, user_b))
+        c.execute('INSERT OR IGNORE INTO friendships (username, friend) VALUES (?,?)', (user_b, user_a))
+
+    def op_add_user_guild(self, username, guild_id):
+        self.conn().execute('INSERT OR IGNORE INTO user_guilds (username, guild_id) VALUES (?,?)',
+                            (username, guild_id))
+
+    def op_remove_user_guild(self, username, guild_id):
+        self.conn().execute('DELETE FROM user_guilds WHERE username=? AND guild_id=?', (username, guild_id))
+
+    def op_add_user_dm(self, username, dm_id):
+        self.conn().execute('INSERT OR IGNORE INTO user_dms (username, dm_id) VALUES (?,?)', (username, dm_id))
+
+    # --- Arkadaşlık istekleri ---
+
+    def op_add_friend_request(self, request):
+        if self.friend_request_exists(request['from'], request['to']):
+            return False
+        self.conn().execute('INSERT INTO friend_requests (id, from_user, to_user) VALUES (?,?,?)',
+                            (request['id'], request['from'], request['to']))
+        return True
+
+    def op_remove_friend_request(self, request_id):
+        self.conn().execute('DELETE FROM friend_requests WHERE id=?', (request_id,))
+
+    # --- DM ---
+
+    def op_add_dm(self, dm):
+        c = self.conn()
+        c.execute('INSERT INTO dms (id) VALUES (?)', (dm['id'],))
+        for username in dm['participants']:
+            c.execute('INSERT OR IGNORE INTO dm_participants (dm_id, username) VALUES (?,?)', (dm['id'], username))
+        for m in dm.get('messages', []):
+            self.op_add_dm_message(dm['id'], m)
+
+    def op_add_dm_message(self, dm_id, message):
+        self.conn().execute(
+            'INSERT INTO dm_messages (id, dm_id, author, content, timestamp, file_base64, file_hash) '
+            'VALUES (?,?,?,?,?,?,?)',
+            (message['id'], dm_id, message['author'], message['content'], message['timestamp'],
+             message.get('file_base64'), message.get('file_hash')))
+
+    def op_edit_dm_message(self, dm_id, message_id, content):
+        self.conn().execute('UPDATE dm_messages SET content=? WHERE id=? AND dm_id=?', (content, message_id, dm_id))
+
+    def op_set_dm_message_file(self, dm_id, message_id, file_hash):
+        self.conn().execute('UPDATE dm_messages SET file_base64=NULL, file_hash=? WHERE id=? AND dm_id=?',
+                            (file_hash, message_id, dm_id))
+
+    def op_delete_dm_message(self, dm_id, message_id):
+        self.conn().execute('DELETE FROM dm_messages WHERE id=? AND dm_id=?', (message_id, dm_id))
+
+    # --- Sunucular ---
+
+    def op_add_guild(self, guild):
+        c = self.conn()
+        gid = guild['id']
+        c.execute('INSERT INTO guilds (id, name, owner) VALUES (?,?,?)', (gid, guild['name'], guild['owner']))
+        for r in guild['roles']:
+            c.execute('INSERT INTO roles (id, guild_id, name, permissions) VALUES (?,?,?,?)',
+                      (r['id'], gid, r['name'], json.dumps(r['permissions'])))
+        for m in guild['members']:
+            self.op_add_member(gid, m)
+        for cat in guild['categories']:
+            self.op_add_category(gid, cat)
+        for ch in guild['channels']:
+            self.op_add_channel(gid, ch)
+        for inv in guild['invites']:
+            self.op_add_invite(gid, inv)
+        for e in guild['emojis']:
+            self.op_add_emoji(gid, e)
+        for entry in guild['audit_logs']:
+            self.op_add_audit_log(gid, entry)
+        for username in guild.get('bans', []):
+            self.op_add_ban(gid, username)
+
+    def op_add_audit_log(self, guild_id, entry):
+        self.conn().execute(
+            'INSERT INTO audit_logs (id, guild_id, action, user, timestamp, details) VALUES (?,?,?,?,?,?)',
+            (entry['id'], guild_id, entry['action'], entry['user'], entry['timestamp'], entry['details']))
+
+    def op_add_category(self, guild_id, category):
+        self.conn().execute('INSERT INTO categories (id, guild_id, name) VALUES (?,?,?)',
+                            (category['id'], guild_id, category['name']))
+
+    def op_add_channel(self, guild_id, channel):
+        voice = channel.get('type') == 'voice'
+        self.conn().execute(
+            'INSERT INTO channels (id, guild_id, category_id, name, description, type, is_private, '
+            'allowed_roles, connected_users, screen_share) VALUES (?,?,?,?,?,?,?,?,?,?)',
+            (channel['id'], guild_id, channel.get('category_id'), channel['name'], channel.get('description'),
+             channel.get('type', 'text'), bool(channel.get('is_private')),
+             json.dumps(channel.get('allowed_roles', [])),
+             json.dumps(channel.get('connected_users', [])) if voice else None,
+             json.dumps(channel.get('screen_share')) if voice else None))
+
+    def voice_users(self, channel_id):
+        row = self.conn().execute('SELECT connected_users FROM channels WHERE id=?', (channel_id,)).fetchone()
+        return json.loads(row['connected_users'] or '[]')
+
+    # Yalnızca eski kayıtların içe aktarımı için; ses oturumları bellekte tutulur
+    def op_add_voice_user(self, guild_id, channel_id, username):
+        users = self.voice_users(channel_id)
+        if username not in users:
+            users.append(username)
+            self.conn().execute('UPDATE channels SET connected_users=? WHERE id=?', (json.dumps(users), channel_id))
+
+    def op_remove_voice_user(self, guild_id, channel_id, username):
+        users = self.voice_users(channel_id)
+        if username in users:
+            users.remove(username)
+            self.conn().execute('UPDATE channels SET connected_users=? WHERE id=?', (json.dumps(users), channel_id))
+
+    def op_set_screen_share(self, guild_id, channel_id, screen_share):
+        self.conn().execute('UPDATE channels SET screen_share=? WHERE id=?', (json.dumps(screen_share), channel_id))
+
+    def op_add_invite(self, guild_id, invite):
+        self.conn().execute(
+            'INSERT INTO invites (id, guild_id, channel_id, created_by, expires_at, uses, max_uses) '
+            'VALUES (?,?,?,?,?,?,?)',
+            (invite['id'], guild_id, invite['channel_id'], invite['created_by'], invite['expires_at'],
+             invite['uses'], invite['max_uses']))
+
+    def op_use_invite(self, guild_id, invite_id):
+        self.conn().execute('UPDATE invites SET uses = uses + 1 WHERE id=?', (invite_id,))
+
+    def op_add_member(self, guild_id, member):
+        self.conn().execute('INSERT OR IGNORE INTO members (guild_id, username, roles, joined_at) VALUES (?,?,?,?)',
+                            (guild_id, member['username'], json.dumps(member['roles']), member.get('joined_at')))
+
+    def op_remove_member(self, guild_id, username):
+        self.conn().execute('DELETE FROM members WHERE guild_id=? AND username=?', (guild_id, username))
+
+    def op_add_ban(self, guild_id, username):
+        self.conn().execute('INSERT OR IGNORE INTO bans (guild_id, username) VALUES (?,?)', (guild_id, username))
+
+    def op_remove_ban(self, guild_id, username):
+        self.conn().execute('DELETE FROM bans WHERE guild_id=? AND username=?', (guild_id, username))
+
+    def op_add_emoji(self, guild_id, emoji):
+        self.conn().execute('INSERT INTO emojis (id, guild_id, name, image_base64, image_hash) VALUES (?,?,?,?,?)',
+                            (emoji['id'], guild_id, emoji['name'], emoji.get('image_base64'),
+                             emoji.get('image_hash')))
+
+    def op_set_emoji_image(self, guild_id, emoji_id, image_hash):
+        self.conn().execute('UPDATE emojis SET image_base64=NULL, image_hash=? WHERE id=? AND guild_id=?',
+                            (image_hash, emoji_id, guild_id))
+
+    def op_remove_emoji(self, guild_id, emoji_id):
+        self.conn().execute('DELETE FROM emojis WHERE id=? AND guild_id=?', (emoji_id, guild_id))
+
+    # --- Sunucu mesajları ---
+
+    def op_add_message(self, message):
+        c = self.conn()
+        c.execute('INSERT INTO messages (id, channel_id, author, content, timestamp, file_base64, pinned, file_hash) '
+                  'VALUES (?,?,?,?,?,?,?,?)',
+                  (message['id'], message['channel_id'], message['author'], message['content'],
+                   message['timestamp'], message.get('file_base64'), bool(message.get('pinned')),
+                   message.get('file_hash')))
+        for r in message.get('reactions', []):
+            for username in r['users']:
+                self.op_add_reaction(message['id'], r['emoji_id'], username)
+
+    def op_edit_message(self, message_id, content):
+        self.conn().execute('UPDATE messages SET content=? WHERE id=?', (content, message_id))
+
+    def op_set_message_file(self, message_id, file_hash):
+        self.conn().execute('UPDATE messages SET file_base64=NULL, file_hash=? WHERE id=?', (file_hash, message_id))
+
+    def op_delete_message(self, message_id):
+        c = self.conn()
+        c.execute('DELETE FROM reactions WHERE message_id=?', (message_id,))
+        c.execute('DELETE FROM messages WHERE id=?', (message_id,))
+
+    def op_pin_message(self, message_id):
+        self.conn().execute('UPDATE messages SET pinned=1 WHERE id=?', (message_id,))
+
+    def op_add_reaction(self, message_id, emoji_id, username):
+        # Arada silinmiş bir mesaja tepki satırı eklenmez
+        self.conn().execute('INSERT OR IGNORE INTO reactions (message_id, emoji_id, username) '
+                            'SELECT ?,?,? WHERE EXISTS (SELECT 1 FROM messages WHERE id=?)',
+                            (message_id, emoji_id, username, message_id))
+
+    def op_remove_reaction(self, message_id, emoji_id, username):
+        self.conn().execute('DELETE FROM reactions WHERE message_id=? AND emoji_id=? AND username=?',
+                            (message_id, emoji_id, username))
+
+def import_json_to_sqlite(data, sqlite_path):
+    """
+    database.json içeriğini (dict) boş bir SQLite veritabanına tek transaction'da aktarır.
+    """
+    store = SqliteStore(sqlite_path)
+    with store.conn():
+        for u in data['users']:
+            store.op_add_user(u)
+        for fr in data['friend_requests']:
+            store.op_add_friend_request(fr)
+        for g in data['guilds']:
+            store.op_add_guild(g)
+        for m in data['messages']:
+            store.op_add_message(m)
+        for dm in data['direct_messages']:
+            store.op_add_dm(dm)
+    return store
+
+@app.cli.command('compact')
+def compact_command():
+    """Yeni bir snapshot alır ve journal'ı sıkıştırır (yalnızca json deposu)."""
+    if app.config['STORAGE_BACKEND'] != 'json':
+        raise click.ClickException("compact is only available for the json backend")
+    db = load_db()
+    if db.compact():
+        click.echo(f"Snapshot written to {DB_PATH} (segment {db.segment})")
+    else:
+        click.echo("Journal is empty, nothing to compact")
+
+@app.cli.command('import-json')
+def import_json_command():
+    """database.json ve journal'ı SQLITE_PATH'e aktarır."""
+    if os.path.exists(SQLITE_PATH):
+        raise click.ClickException(f"{SQLITE_PATH} already exists")
+    data = JsonStore(DB_PATH, JOURNAL_PATH).export()
+    import_json_to_sqlite(data, SQLITE_PATH)
+    click.echo(f"Imported {len(data['users'])} users, {len(data['guilds'])} guilds, "
+               f"{len(data['messages'])} messages into {SQLITE_PATH}")
+
+##########################
+# Ek Dosya Deposu        #
+##########################
+
+class BlobStore:
+    """
+    Ekleri içerik özetine (sha256) göre diske yazar: <kök>/<ilk 2 hane>/<özet>.
+    Aynı içerik ikinci kez yüklenirse yeniden yazılmaz; mesajlar yalnızca özeti tutar.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def exists(self, digest):
+        return os.path.exists(self.path(digest))
+
+    def put(self, data):
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f'{path}.{uuid.uuid4().hex}.tmp'
+            with open(tmp, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, path)
+        return digest
+
+blob_store = BlobStore(BLOB_PATH)
+
+@app.cli.command('migrate-attachments')
+def migrate_attachments_command():
+    """Mesaj eklerini (file_base64) ve emoji görsellerini (image_base64) blob deposuna taşır."""
+    db = load_db()
+    moved, skipped = 0, 0
+    for guild_id, emoji_id, image_base64 in db.inline_emojis():
+        data = decode_upload(image_base64)
+        if data is None:
+            skipped += 1
+            continue
+        commit('set_emoji_image', guild_id=guild_id, emoji_id=emoji_id, image_hash=blob_store.put(data))
+        moved += 1
+    for dm_id, message_id, file_base64 in db.inline_attachments():
+        data = decode_upload(file_base64)
+        if data is None:
+            skipped += 1
+            continue
+        digest = blob_store.put(data)
+        if dm_id is None:
+            commit('set_message_file', message_id=message_id, file_hash=digest)
+        else:
+            commit('set_dm_message_file', dm_id=dm_id, message_id=message_id, file_hash=digest)
+        moved += 1
+    click.echo(f"Moved {moved} attachments and emoji images into {BLOB_PATH}, skipped {skipped} undecodable")
+
+##########################
+# Arama İndeksi          #
+##########################
+
+def search_terms(text):
+    """
+    Metni aranabilir kelimelere böler. Büyük/küçük harf ve aksanlar katlanır,
+    Türkçe ı/İ de i'ye indirgenir; böylece "IŞIK", "ışık" ve "isik" eşleşir.
+    """
+    text = unicodedata.normalize('NFKD', text.casefold())
+    text = ''.join(ch for ch in text if not unicodedata.combining(ch)).replace('ı', 'i')
+    return re.findall(r'\w+', text)
+
+class SearchIndex:
+    """
+    Sunucu mesajları için artımlı ters indeks: kelime -> {message_id: tekrar sayısı}.
+    İlk aramada depodan kurulur, sonra commit() dinleyicisiyle güncel tutulur.
+    Kurulum, yazarların beklediği kilidi tutmadan ayrı sözlüklere yapılır;
+    bu sırada gelen değişiklikler 'pending'e yazılır ve sonunda uygulanır.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Aynı anda gelen ilk aramalardan yalnızca biri kurar
+        self.build_lock = threading.Lock()
+        self.built = False
+        self.pending = None
+        self.postings = {}
+        self.docs = {}
+
+    def ensure_built(self, db):
+        if self.built:
+            return
+        with self.build_lock:
+            if self.built:
+                return
+            with self.lock:
+                self.pending = []
+            fresh = SearchIndex()
+            for m in iter_messages(db):
+                fresh._add(m)
+            with self.lock:
+                self.postings, self.docs = fresh.postings, fresh.docs
+                # Tarama sırasında commit edilenler taramada da görülmüş
+                # olabilir; _add önce eski kaydı sildiğinden tekrar zararsızdır
+                for change in self.pending:
+                    self._apply(*change)
+                self.pending = None
+                self.built = True
+
+    def _add(self, message):
+        self._remove(message['id'])
+        counts = {}
+        for term in search_terms(message['content'] or ""):
+            counts[term] = counts.get(term, 0) + 1
+        for term, tf in counts.items():
+            self.postings.setdefault(term, {})[message['id']] = tf
+        self.docs[message['id']] = (message['channel_id'], message['author'], message['timestamp'],
+                                    tuple(counts))
+
+    def _remove(self, message_id):
+        doc = self.docs.pop(message_id, None)
+        if not doc:
+            return
+        for term in doc[3]:
+            posting = self.postings[term]
+            posting.pop(message_id, None)
+            if not posting:
+                del self.postings[term]
+
+    def _update_content(self, message_id, content):
+        doc = self.docs.get(message_id)
+        if doc:
+            self._add({"id": message_id, "channel_id": doc[0], "author": doc[1],
+                       "timestamp": doc[2], "content": content})
+
+    def _apply(self, method, *args):
+        getattr(self, method)(*args)
+
+    def _record(self, method, *args):
+        # Kurulmuşsa hemen uygulanır, kurulurken sıraya alınır; hiç
+        # kurulmamışsa atlanır (kurulum depodan okuyacak)
+        with self.lock:
+            if self.built:
+                self._apply(method, *args)
+            elif self.pending is not None:
+                self.pending.append((method,) + args)
+
+    def add(self, message):
+        self._record('_add', message)
+
+    def update_content(self, message_id, content):
+        self._record('_update_content', message_id, content)
+
+    def remove(self, message_id):
+        self._record('_remove', message_id)
+
+    def search(self, terms, visible, author=None, sort='relevance'):
+        """
+        Tüm kelimeleri içeren ve visible(channel_id) True dönen mesajların
+        id'lerini sıralı döndürür. Maliyet en kısa posting listesiyle orantılıdır.
+        """
+        with self.lock:
+            postings = [self.postings.get(t) for t in set(terms)]
+            if not all(postings):
+                return []
+            postings.sort(key=len)
+            n = len(self.docs)
+            weights = [math.log(1 + n / len(p)) for p in postings]
+            hits = []
+            for mid in postings[0]:
+                if not all(mid in p for p in postings[1:]):
+                    continue
+                channel_id, msg_author, timestamp, _ = self.docs[mid]
+                if author and msg_author != author:
+                    continue
+                if not visible(channel_id):
+                    continue
+                score = sum(p[mid] * w for p, w in zip(postings, weights))
+                hits.append((score, timestamp, mid))
+        if sort == 'recent':
+            hits.sort(key=lambda h: h[1], reverse=True)
+        else:
+            hits.sort(key=lambda h: (h[0], h[1]), reverse=True)
+        return [mid for _, _, mid in hits]
+
+search_index = SearchIndex()
+
+@on_mutation
+def update_search_index(op, args):
+    if op == 'add_message':
+        search_index.add(args['message'])
+    elif op == 'edit_message':
+        search_index.update_content(args['message_id'], args['content'])
+    elif op == 'delete_message':
+        search_index.remove(args['message_id'])
+
+##########################
+# Yetki Önbelleği        #
+##########################
+
+# Bilinen yetkilerin bit sırası; listede olmayan bir yetki adı ilk
+# görüldüğünde sıradaki biti alır.
+PERMISSIONS = [
+    "read_messages",
+    "send_messages",
+    "manage_channels",
+    "manage_roles",
+    "manage_guild",
+    "kick_members",
+    "ban_members"
+]
+
+class PermissionCache:
+    """
+    Sunucu başına {kullanıcı: [maske, roller, {kanal_id: izin}]} tutar.
+    Maske üyenin rollerindeki yetkilerin OR'lanmış bitleridir, üye değilse None.
+    Kayıtlar ilk sorguda derlenir ve yalnızca üyelik/rol/kanal değişince silinir;
+    böylece bir yetki kontrolü birkaç tamsayı işlemine iner.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.bits = {name: 1 << i for i, name in enumerate(PERMISSIONS)}
+        self.guilds = {}
+        self.generations = {}
+
+    def bit(self, name):
+        bit = self.bits.get(name)
+        if bit is None:
+            with self.lock:
+                bit = self.bits.setdefault(name, 1 << len(self.bits))
+        return bit
+
+    def compile(self, guild, username):
+        member = user_in_guild(guild, username)
+        if not member:
+            return [None, frozenset(), {}]
+        roles = frozenset(member['roles'])
+        mask = 0
+        for r in guild['roles']:
+            if r['name'] in roles:
+                for name, allowed in r['permissions'].items():
+                    if allowed:
+                        mask |= self.bit(name)
+        return [mask, roles, {}]
+
+    def entry(self, guild, username):
+        guild_id = guild['id']
+        with self.lock:
+            e = self.guilds.get(guild_id, {}).get(username)
+            if e is not None:
+                return e
+            generation = self.generations.get(guild_id, 0)
+        # Derleme kilit dışında ve güncel sunucu kaydı üzerinden yapılır;
+        # arada bir geçersizleştirme olduysa sonuç önbelleğe yazılmaz.
+        e = self.compile(load_db().find_guild(guild_id) or guild, username)
+        with self.lock:
+            if self.generations.get(guild_id, 0) == generation:
+                self.guilds.setdefault(guild_id, {})[username] = e
+        return e
+
+    def is_member(self, guild, username):
+        return self.entry(guild, username)[0] is not None
+
+    def has_permission(self, guild, username, permission):
+        mask = self.entry(guild, username)[0]
+        return mask is not None and mask & self.bit(permission) != 0
+
+    def can_access(self, guild, username, channel):
+        if not is_channel_private(channel):
+            return True
+        mask, roles, channels = self.entry(guild, username)
+        if mask is None:
+            return False
+        allowed = channels.get(channel['id'])
+        if allowed is None:
+            allowed = not roles.isdisjoint(channel.get('allowed_roles', []))
+            channels[channel['id']] = allowed
+        return allowed
+
+    def forget_member(self, guild_id, username):
+        with self.lock:
+            self.guilds.get(guild_id, {}).pop(username, None)
+            self.generations[guild_id] = self.generations.get(guild_id, 0) + 1
+
+    def forget_channel(self, guild_id, channel_id):
+        with self.lock:
+            for e in self.guilds.get(guild_id, {}).values():
+                e[2].pop(channel_id, None)
+            self.generations[guild_id] = self.generations.get(guild_id, 0) + 1
+
+    def forget_guild(self, guild_id):
+        with self.lock:
+            self.guilds.pop(guild_id, None)
+            self.generations[guild_id] = self.generations.get(guild_id, 0) + 1
+
+permission_cache = PermissionCache()
+
+@on_mutation
+def invalidate_permissions(op, args):
+    if op == 'add_member':
+        permission_cache.forget_member(args['guild_id'], args['member']['username'])
+    elif op == 'remove_member':
+        permission_cache.forget_member(args['guild_id'], args['username'])
+    elif op == 'add_channel':
+        permission_cache.forget_channel(args['guild_id'], args['channel']['id'])
+    elif op == 'add_guild':
+        permission_cache.forget_guild(args['guild']['id'])
+
+##########################
+# Son Mesaj Önbelleği    #
+##########################
+
+class RecentMessageCache:
+    """
+    Kanal başına son RECENT_MESSAGES mesajın halka tamponu (deque). İmleçsiz
+    /messages isteklerini depoya (diske ya da mmap'e) gitmeden karşılar.
+    Tampon kanalın ilk okunuşunda doldurulur, sonra commit() dinleyicisiyle
+    güncel tutulur. Toplam boyut RECENT_CACHE_BYTES'ı aşınca en uzun süredir
+    okunmayan kanalların tamponları atılır.
+    """
+
+    def __init__(self, size, budget):
+        self.lock = threading.Lock()
+        self.size = size
+        self.budget = budget
+        # channel_id -> [deque, bayt, tamam]; 'tamam' tamponun kanalın tüm
+        # geçmişini içerdiğini (daha eski mesaj olmadığını) gösterir
+        self.channels = OrderedDict()
+        # Tampondaki mesajların kanalı; silinen mesaj depoda artık bulunmaz
+        self.where = {}
+        self.generations = {}
+        # Tamponda olmayan bir mesaj silinince artar; o sırada dolmakta olan
+        # bir tampon silinen mesajı içerebileceğinden önbelleğe yazılmaz
+        self.deletions = 0
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def message_bytes(self, message):
+        # Yaklaşık: JSON boyu artı dict ve deque başına sabit bir pay
+        return len(json.dumps(message, ensure_ascii=False)) + 200
+
+    def latest(self, db, channel_id, limit):
+        """
+        Kanalın son 'limit' mesajı: (messages, has_more). Tampon yoksa ya da
+        isteği karşılamaya yetmiyorsa depodan doldurulur.
+        """
+        with self.lock:
+            e = self.channels.get(channel_id)
+            # Tampon doluysa ya da kanalın tamamını içeriyorsa yeterlidir.
+            # Tamponun dışında kalan eski mesajların hepsi silinmişse
+            # has_more yine True döner; sonraki sayfa boş gelir.
+            if e is not None and (len(e[0]) >= limit or e[2]):
+                self.channels.move_to_end(channel_id)
+                self.hits += 1
+                msgs = list(e[0])
+                return msgs[max(0, len(msgs) - limit):], len(msgs) > limit or not e[2]
+            self.misses += 1
+            version = (self.generations.get(channel_id, 0), self.deletions)
+        msgs, has_more = db.channel_messages(channel_id, max(self.size, limit))
+        # Okuma kilit dışında yapılır; arada kanala bir yazı geldiyse sonuç
+        # önbelleğe yazılmaz
+        with self.lock:
+            if (self.generations.get(channel_id, 0), self.deletions) == version:
+                self._drop(channel_id)
+                e = self.channels[channel_id] = [deque(maxlen=self.size), 0, not has_more]
+                for m in msgs:
+                    self._append(channel_id, e, m)
+                self._evict()
+        return msgs[max(0, len(msgs) - limit):], len(msgs) > limit or has_more
+
+    def _append(self, channel_id, e, message):
+        buf = e[0]
+        if len(buf) == buf.maxlen:
+            self._forget(e, buf[0])
+            e[2] = False
+        buf.append(message)
+        self.where[message['id']] = channel_id
+        self._resize(e, self.message_bytes(message))
+
+    def _forget(self, e, message):
+        self.where.pop(message['id'], None)
+        self._resize(e, -self.message_bytes(message))
+
+    def _resize(self, e, delta):
+        e[1] += delta
+        self.bytes += delta
+
+    def _drop(self, channel_id):
+        e = self.channels.pop(channel_id, None)
+        if e is not None:
+            for m in e[0]:
+                self.where.pop(m['id'], None)
+            self.bytes -= e[1]
+
+    def _evict(self):
+        while self.bytes > self.budget and self.channels:
+            self._drop(next(iter(self.channels)))
+            self.evictions += 1
+
+    def add(self, message):
+        channel_id = message['channel_id']
+        with self.lock:
+            self.generations[channel_id] = self.generations.get(channel_id, 0) + 1
+            e = self.channels.get(channel_id)
+            if e is None:
+                return
+            if e[0] and iso_to_micros(e[0][-1]['timestamp']) > iso_to_micros(message['timestamp']):
+                # Eski tarihli mesaj (ör. başka bir işçinin geciken yazısı);
+                # tampon bir sonraki okumada yeniden doldurulur
+                self._drop(channel_id)
+                return
+            self._append(channel_id, e, message)
+            self._evict()
+
+    def replace(self, message_id, message):
+        """Tampondaki mesajı yenisiyle değiştirir; message None ise (silindi) çıkarır."""
+        with self.lock:
+            channel_id = self.where.get(message_id)
+            if channel_id is None:
+                if message is None:
+                    self.deletions += 1
+                else:
+                    channel_id = message['channel_id']
+                    self.generations[channel_id] = self.generations.get(channel_id, 0) + 1
+                return
+            self.generations[channel_id] = self.generations.get(channel_id, 0) + 1
+            e = self.channels[channel_id]
+            buf = e[0]
+            for i, m in enumerate(buf):
+                if m['id'] == message_id:
+                    self._forget(e, m)
+                    if message is None:
+                        del buf[i]
+                    else:
+                        buf[i] = message
+                        self.where[message_id] = channel_id
+                        self._resize(e, self.message_bytes(message))
+                    break
+            self._evict()
+
+    def stats(self):
+        with self.lock:
+            return {"channels": len(self.channels), "bytes": self.bytes, "budget": self.budget,
+                    "size": self.size, "hits": self.hits, "misses": self.misses,
+                    "evictions": self.evictions}
+
+recent_messages = RecentMessageCache(RECENT_MESSAGES, RECENT_CACHE_BYTES)
+
+@on_mutation
+def update_recent_messages(op, args):
+    # Dinleyici op'un bölüm kilidi altında çalışır; depodan okunan mesaj
+    # op uygulanmış haldedir
+    if op == 'add_message':
+        recent_messages.add(load_db().find_message(args['message']['id']) or args['message'])
+    elif op in MESSAGE_OPS:
+        recent_messages.replace(args['message_id'], load_db().find_message(args['message_id']))
+
+##########################
+# Yanıt Önbelleği        #
+##########################
+
+class ResponseCache:
+    """
+    Sık okunan GET uçlarının serileştirilmiş yanıtları: anahtar -> (sürüm,
+    (etag, gövde)). Kaynak sürümleri commit() tarafından op_resources() ile
+    artırılır; depoya yazılmayan canlı durumlar (çevrimiçi durumu, ses
+    bağlantıları) kendi sayaçlarıyla sürüme eklenir. Sürümü eşleşmeyen kayıt
+    kullanılmaz, en uzun süredir okunmayan kayıtlar sığmayınca atılır.
+    """
+
+    def __init__(self, size):
+        self.lock = threading.Lock()
+        self.size = size
+        self.entries = OrderedDict()
+        self.versions = {}
+        # Sürüm sayaçları açılışta sıfırdan başlar; ETag'ler bu kimlikle
+        # ayrıştırılır ki yeniden başlatma öncesinin ETag'i yanlışlıkla eşleşmesin
+        self.boot_id = uuid.uuid4().hex
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+
+    def version(self, resource):
+        return self.versions.get(resource, 0)
+
+    def bump(self, resources):
+        with self.lock:
+            for resource in resources:
+                self.versions[resource] = self.versions.get(resource, 0) + 1
+
+    def get(self, key, version):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == version:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+
+    def put(self, key, version, value):
+        # Oluşturma sırasında kaynak değiştiyse kayıt eski sürümle yazılır ve
+        # bir sonraki okumada kullanılmaz
+        with self.lock:
+            self.entries[key] = (version, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def etag(self, key, version):
+        return hashlib.sha1(repr((self.boot_id, key, version)).encode('utf-8')).hexdigest()
+
+    def not_modified_response(self, etag):
+        """İstemcideki kopya güncelse gövdesiz 304 yanıtı, değilse None."""
+        if etag not in request.if_none_match:
+            return None
+        with self.lock:
+            self.not_modified += 1
+        resp = Response(status=304)
+        resp.set_etag(etag)
+        return resp
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "size": self.size, "hits": self.hits,
+                    "misses": self.misses, "not_modified": self.not_modified}
+
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE)
+
+def json_response(body, etag):
+    resp = Response(body, mimetype=app.json.mimetype)
+    resp.set_etag(etag)
+    return resp
+
+def cached_json(key, version, build):
+    """
+    build() sonucunu JSON yanıtı olarak döndürür; aynı anahtar ve sürüm için
+    daha önce serileştirilmiş gövde varsa build() ve jsonify atlanır. ETag
+    anahtar ve sürümden türetilir; If-None-Match eşleşirse hiçbir şey
+    okunmadan 304 döner. build() dict yerine bir hata yanıtı döndürürse o
+    yanıt önbelleğe alınmadan verilir.
+    """
+    etag = response_cache.etag(key, version)
+    resp = response_cache.not_modified_response(etag)
+    if resp is not None:
+        return resp
+    body = response_cache.get(key, version)
+    if body is None:
+        payload = build()
+        if not isinstance(payload, dict):
+            return payload
+        body = jsonify(payload).get_data()
+        response_cache.put(key, version, body)
+    return json_response(body, etag)
+
+def stream_json(name, items):
+    """
+    {"<name>": [...]} gövdesini elemanlar üretildikçe, STREAM_BATCH'lik
+    parçalar halinde veren generator. Bellekte en fazla bir parça tutulur.
+    Elemanlar jsonify ile aynı ayarlarla kodlanır.
+    """
+    encoder = json.JSONEncoder(ensure_ascii=app.json.ensure_ascii, sort_keys=app.json.sort_keys,
+                               separators=(',', ':'), default=app.json.default)
+    prefix = '{%s:[' % json.dumps(name)
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == STREAM_BATCH:
+            # Parça bir dizi olarak kodlanıp köşeli parantezleri atılır
+            yield prefix + encoder.encode(batch)[1:-1]
+            prefix, batch = ',', []
+    rest = encoder.encode(batch)[1:-1]
+    if prefix == ',' and not rest:
+        prefix = ''
+    yield prefix + rest + ']}\n'
+
+def cached_listing(key, version, name, items):
+    """
+    Büyüyebilen listeler için cached_json: gövde önbellekte yoksa
+    stream_json() ile akışla (chunked) gönderilir, ilk bayt liste
+    bitmeden çıkar. Gövde RESPONSE_CACHE_MAX_BODY'yi aşmazsa akış
+    bitince önbelleğe yazılır. items() listeyi üreten bir iterator döndürür.
+    """
+    etag = response_cache.etag(key, version)
+    resp = response_cache.not_modified_response(etag)
+    if resp is not None:
+        return resp
+    body = response_cache.get(key, version)
+    if body is not None:
+        return json_response(body, etag)
+
+    def generate():
+        parts, size = [], 0
+        for chunk in stream_json(name, items()):
+            if parts is not None:
+                size += len(chunk)
+                parts.append(chunk)
+                if size > RESPONSE_CACHE_MAX_BODY:
+                    parts = None
+            yield chunk
+        if parts is not None:
+            response_cache.put(key, version, ''.join(parts).encode('utf-8'))
+
+    return json_response(generate(), etag)
+
+##########################
+# Olay Geçidi (SSE)      #
+##########################
+
+class Subscriber:
+    """
+    Bir /gateway bağlantısı: kullanıcı, abone olduğu konular ve sınırlı bir kuyruk.
+    Kuyruk dolarsa (istemci yetişemiyorsa) bağlantı resync ile kapatılır.
+    """
+
+    QUEUE_SIZE = 1000
+
+    def __init__(self, username, topics):
+        self.username = username
+        self.topics = topics
+        self.queue = queue.Queue(maxsize=self.QUEUE_SIZE)
+        self.overflowed = False
+
+    def push(self, frame):
+        try:
+            self.queue.put_nowait(frame)
+        except queue.Full:
+            self.overflowed = True
+
+class EventBus:
+    """
+    Konu ('guild:<id>', 'dm:<id>', 'user:<ad>') başına aboneleri tutar. Olay bir kez
+    SSE çerçevesine çevrilir ve yalnızca görebilen abonelerin kuyruğuna eklenir.
+    Her olay artan bir sıra numarası (seq) alır ve son CHANGE_RING_SIZE olay
+    /changes için halkada tutulur; bekleyen istekler cond üzerinde uyur.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.topics = {}
+        self.seq = 0
+        self.ring = deque(maxlen=CHANGE_RING_SIZE)
+
+    def subscribe(self, username, topics):
+        sub = Subscriber(username, topics)
+        with self.lock:
+            for t in topics:
+                self.topics.setdefault(t, set()).add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self.lock:
+            for t in sub.topics:
+                subs = self.topics.get(t)
+                if subs is not None:
+                    subs.discard(sub)
+                    if not subs:
+                        del self.topics[t]
+
+    def publish(self, topic, event_type, data, visible=None):
+        # data, depodaki canlı dokümanları gösterebilir; sonraki değişiklikler
+        # olayı bozmasın diye yayın anında JSON'a çevrilir.
+        payload = json.dumps(data, ensure_ascii=False)
+        with self.cond:
+            self.seq += 1
+            seq = self.seq
+            self.ring.append((seq, topic, event_type, payload, visible))
+            self.cond.notify_all()
+            subs = list(self.topics.get(topic, ()))
+        if not subs:
+            return
+        frame = sse_frame(event_type, payload, seq)
+        for sub in subs:
+            if visible is None or visible(sub.username):
+                sub.push(frame)
+
+    def changes(self, username, topics, since, timeout):
+        """
+        since'tan sonraki, kullanıcının görebileceği olayları döndürür; yoksa
+        timeout saniyeye kadar bekler. Dönüş: (olaylar, yeni imleç, reset).
+        reset True ise istemci aradaki olayları kaçırmıştır (halka taştı veya
+        sunucu yeniden başladı) ve durumu baştan yüklemelidir.
+        """
+        deadline = time.monotonic() + timeout
+        cursor = since
+        with self.cond:
+            if since > self.seq or (self.ring and since < self.ring[0][0] - 1):
+                return [], self.seq, True
+        while True:
+            with self.cond:
+                while self.seq <= cursor:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return [], cursor, False
+                    self.cond.wait(remaining)
+                # seq'ler ardışık olduğundan yeni kayıtlar halkanın son
+                # (seq - cursor) elemanıdır; tüm halka taranmaz.
+                fresh = min(self.seq - cursor, len(self.ring))
+                records = [r for r in itertools.islice(reversed(self.ring), fresh)
+                           if r[1] in topics]
+                records.reverse()
+                cursor = self.seq
+            found = [{"seq": seq, "type": event_type, "data": json.loads(payload)}
+                     for seq, _, event_type, payload, visible in records
+                     if visible is None or visible(username)]
+            if found or time.monotonic() >= deadline:
+                return found, cursor, False
+
+def sse_frame(event_type, payload, seq=None):
+    frame = f"event: {event_type}\ndata: {payload}\n\n"
+    return frame if seq is None else f"id: {seq}\n" + frame
+
+event_bus = EventBus()
+
+def publish_event(event_type, data, guild=None, channel=None, dm_id=None, user=None):
+    """
+    Rotaların değişiklikten sonra çağırdığı yayın noktası. DM olayları DM'in
+    katılımcılarına, sunucu olayları sunucu üyelerine gider; channel verilirse
+    private kanal erişimi yetki önbelleğinden kontrol edilir. user verilirse
+    olay yalnızca o kullanıcının konusuna gider (profil, arkadaşlık, yeni DM).
+    """
+    if user is not None:
+        event_bus.publish('user:' + user, event_type, data)
+        return
+    if dm_id is not None:
+        event_bus.publish('dm:' + dm_id, event_type, dict(data, dm_id=dm_id))
+        return
+
+    # Olay /changes halkasında bir süre yaşar; sunucu dokümanının tamamı yerine
+    # erişim kontrolü için gereken alanlar tutulur.
+    guild = {"id": guild['id']}
+    if channel is not None:
+        channel = {k: channel.get(k) for k in ('id', 'is_private', 'allowed_roles')}
+
+    def visible(username):
+        if not is_guild_member(guild, username):
+            return False
+        return channel is None or permission_cache.can_access(guild, username, channel)
+
+    event_bus.publish('guild:' + guild['id'], event_type, dict(data, guild_id=guild['id']), visible)
+
+##########################
+# Çevrimiçi Durum        #
+##########################
+
+PRESENCE_STATUSES = ('online', 'idle')
+
+class PresenceRegistry:
+    """
+    Kullanıcı durumları yalnızca bellekte: {username: (durum, son heartbeat)}.
+    Son heartbeat'ten PRESENCE_TTL saniye geçince kullanıcı 'offline' olur;
+    süresi dolan kayıtlar okunurken silinir. Diske hiçbir şey yazılmaz.
+    Görünen bir durum değiştikçe 'changes' artar (/users yanıt sürümü).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.changes = 0
+        # (son heartbeat, kullanıcı) yığını; süresi dolanları taramadan bulmak için
+        self.heartbeats = []
+
+    def _expire(self):
+        now = time.monotonic()
+        while self.heartbeats and now - self.heartbeats[0][0] > PRESENCE_TTL:
+            last_seen, username = heapq.heappop(self.heartbeats)
+            entry = self.sessions.get(username)
+            # Daha yeni bir heartbeat geldiyse yığındaki kayıt eskidir
+            if entry is not None and entry[1] == last_seen:
+                del self.sessions[username]
+                self.changes += 1
+
+    def touch(self, username, status='online'):
+        now = time.monotonic()
+        with self.lock:
+            self._expire()
+            previous = self.sessions.get(username)
+            if previous is None or previous[0] != status:
+                self.changes += 1
+            self.sessions[username] = (status, now)
+            heapq.heappush(self.heartbeats, (now, username))
+
+    def clear(self, username):
+        with self.lock:
+            if self.sessions.pop(username, None) is not None:
+                self.changes += 1
+
+    def version(self):
+        with self.lock:
+            self._expire()
+            return self.changes
+
+    def status(self, username):
+        entry = self.sessions.get(username)
+        if entry is None:
+            return 'offline'
+        status, last_seen = entry
+        if time.monotonic() - last_seen > PRESENCE_TTL:
+            with self.lock:
+                if self.sessions.get(username) is entry:
+                    del self.sessions[username]
+                    self.changes += 1
+            return 'offline'
+        return status
+
+    def fields(self, username):
+        status = self.status(username)
+        return {"online": status != 'offline', "status": status}
+
+presence = PresenceRegistry()
+
+##########################
+# Ses Oturumları         #
+##########################
+
+class VoiceSession:
+    __slots__ = ('username', 'guild_id', 'channel_id', 'joined_at', 'last_seen')
+
+    def __init__(self, username, guild_id, channel_id):
+        self.username = username
+        self.guild_id = guild_id
+        self.channel_id = channel_id
+        self.joined_at = datetime.utcnow().isoformat()
+        self.last_seen = time.monotonic()
+
+class VoiceStateManager:
+    """
+    Ses kanalı bağlantıları ve ekran paylaşımları yalnızca bellekte tutulur:
+    guilds[guild_id][channel_id][username] ve users[username][channel_id]
+    aynı VoiceSession nesnesini gösterir. VOICE_TTL boyunca heartbeat
+    gelmeyen oturumlar okunurken düşürülür; yeniden başlatmada hepsi sıfırlanır.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.guilds = {}
+        self.users = {}
+        self.screen_shares = {}
+        # Sunucu başına değişiklik sayacı (/guild/<id> yanıt sürümü)
+        self.changes = {}
+
+    def _changed(self, guild_id):
+        self.changes[guild_id] = self.changes.get(guild_id, 0) + 1
+
+    def _drop(self, session):
+        self._changed(session.guild_id)
+        channels = self.guilds.get(session.guild_id, {})
+        sessions = channels.get(session.channel_id, {})
+        sessions.pop(session.username, None)
+        if not sessions:
+            channels.pop(session.channel_id, None)
+        if not channels:
+            self.guilds.pop(session.guild_id, None)
+        mine = self.users.get(session.username, {})
+        mine.pop(session.channel_id, None)
+        if not mine:
+            self.users.pop(session.username, None)
+        share = self.screen_shares.get(session.channel_id)
+        if share and share['user'] == session.username:
+            del self.screen_shares[session.channel_id]
+
+    def _expire(self, guild_id):
+        deadline = time.monotonic() - VOICE_TTL
+        stale = [s for sessions in self.guilds.get(guild_id, {}).values()
+                 for s in sessions.values() if s.last_seen < deadline]
+        for s in stale:
+            self._drop(s)
+
+    def join(self, guild_id, channel_id, username):
+        """
+        Kullanıcıyı kanala bağlar; zaten bağlıysa yalnızca oturumu tazeler ve False döner.
+        """
+        with self.lock:
+            self._expire(guild_id)
+            sessions = self.guilds.setdefault(guild_id, {}).setdefault(channel_id, {})
+            if username in sessions:
+                sessions[username].last_seen = time.monotonic()
+                return False
+            session = VoiceSession(username, guild_id, channel_id)
+            sessions[username] = session
+            self.users.setdefault(username, {})[channel_id] = session
+            self._changed(guild_id)
+            return True
+
+    def leave(self, guild_id, channel_id, username):
+        with self.lock:
+            session = self.guilds.get(guild_id, {}).get(channel_id, {}).get(username)
+            if session is None:
+                return False
+            self._drop(session)
+            return True
+
+    def leave_guild(self, guild_id, username):
+        """
+        Kullanıcının sunucudaki tüm oturumlarını kapatır (kick/ban); kanal id'lerini döndürür.
+        """
+        with self.lock:
+            left = [s for s in self.users.get(username, {}).values() if s.guild_id == guild_id]
+            for s in left:
+                self._drop(s)
+        return [s.channel_id for s in left]
+
+    def touch(self, username):
+        now = time.monotonic()
+        with self.lock:
+            for s in self.users.get(username, {}).values():
+                s.last_seen = now
+
+    def is_connected(self, guild_id, channel_id, username):
+        with self.lock:
+            self._expire(guild_id)
+            return username in self.guilds.get(guild_id, {}).get(channel_id, {})
+
+    def connected_users(self, guild_id, channel_id):
+        with self.lock:
+            self._expire(guild_id)
+            return list(self.guilds.get(guild_id, {}).get(channel_id, {}))
+
+    def screen_share(self, guild_id, channel_id):
+        with self.lock:
+            self._expire(guild_id)
+            return self.screen_shares.get(channel_id, {"active": False, "user": None})
+
+    def set_screen_share(self, guild_id, channel_id, share):
+        with self.lock:
+            self._changed(guild_id)
+            if share is None:
+                self.screen_shares.pop(channel_id, None)
+            else:
+                self.screen_shares[channel_id] = share
+
+    def version(self, guild_id):
+        with self.lock:
+            self._expire(guild_id)
+            return self.changes.get(guild_id, 0)
+
+    def guild_states(self, guild_id):
+        """
+        Sunucudaki tüm ses bağlantıları; sunucu bir sözlük aramasıyla bulunur.
+        """
+        with self.lock:
+            self._expire(guild_id)
+            return [{
+                "channel_id": s.channel_id,
+                "username": s.username,
+                "joined_at": s.joined_at,
+                "screen_sharing": self.screen_shares.get(s.channel_id, {}).get('user') == s.username
+            } for sessions in self.guilds.get(guild_id, {}).values() for s in sessions.values()]
+
+voice_state = VoiceStateManager()
+
+def with_voice_state(guild_id, channel):
+    """
+    Ses kanalının saklanan connected_users/screen_share alanlarını canlı durumla değiştirir.
+    """
+    if channel.get('type') != 'voice':
+        return channel
+    return dict(channel,
+                connected_users=voice_state.connected_users(guild_id, channel['id']),
+                screen_share=voice_state.screen_share(guild_id, channel['id']))
+
 ##########################
 # Kullanıcı İşlemleri    #
 ##########################
@@ -183,8 +3361,9 @@ def register():
         "dm_channels": [],
         "avatar_url": avatar_url
     }
-    db['users'].append(new_user)
-    save_db(db)
+    if not commit('add_user', user=new_user):
+        return jsonify({"status": "error", "message": "Username already exists"}), 400
+    publish_event('user_create', {"username": username}, user=username)
     return jsonify({"status": "success", "message": "User registered"})
 
 
@@ -199,9 +3378,8 @@ def login():
     user = find_user(db, username)
     if not user or user['password'] != password:
         return jsonify({"status": "error", "message": "Invalid credentials"}), 401
-    user['online'] = True
-    save_db(db)
-    return jsonify({"status": "success", "token": username})
+    presence.touch(username)
+    return jsonify({"status": "success", "token": username, "heartbeat_interval": PRESENCE_TTL // 3})
 
 
 # /logout [POST]
@@ -215,11 +3393,32 @@ def logout():
     user = find_user_by_token(db, token)
     if not user:
         return jsonify({"status": "error", "message": "Invalid token"}), 401
-    user['online'] = False
-    save_db(db)
+    presence.clear(user['username'])
     return jsonify({"status": "success", "message": "Logged out"})
 
 
+# /heartbeat [POST]
+# Body (opsiyonel): {"status":"online"|"idle"}
+# İstemci heartbeat_interval saniyede bir çağırır; gelmezse kullanıcı çevrimdışı düşer.
+@app.route('/heartbeat', methods=['POST'])
+def heartbeat():
+    db = load_db()
+    auth = request.headers.get('Authorization')
+    if not auth or not auth.startswith("Bearer "):
+        return jsonify({"status": "error", "message": "Unauthorized"}), 401
+    token = auth.split(" ")[1]
+    user = find_user_by_token(db, token)
+    if not user:
+        return jsonify({"status": "error", "message": "Invalid token"}), 401
+    data = request.get_json(silent=True) or {}
+    status = data.get('status', 'online')
+    if status not in PRESENCE_STATUSES:
+        return jsonify({"status": "error", "message": "Invalid status"}), 400
+    presence.touch(user['username'], status)
+    voice_state.touch(user['username'])
+    return jsonify({"status": "success", "presence": status, "heartbeat_interval": PRESENCE_TTL // 3})
+
+
 # /user/<username> [GET]
 @app.route('/user/<username>', methods=['GET'])
 def get_user_info(username):
@@ -227,9 +3426,10 @@ def get_user_info(username):
     user = find_user(db, username)
     if not user:
         return jsonify({"status": "error", "message": "User not found"}), 404
-    return jsonify({
+    version = (response_cache.version(('user', username)), presence.status(username))
+    return cached_json(('user', username), version, lambda: {
         "username": user['username'],
-        "online": user['online'],
+        **presence.fields(user['username']),
         "friends": user['friends'],
         "guilds": user['guilds'],
         "dm_channels": user['dm_channels'],
@@ -240,14 +3440,14 @@ def get_user_info(username):
 @app.route('/users', methods=['GET'])
 def list_users():
     db = load_db()
-    users_list = []
-    for u in db['users']:
-        users_list.append({
-            "username": u['username'],
-            "online": u['online'],
-            "avatar_url": u['avatar_url']
-        })
-    return jsonify({"users": users_list})
+
+    def users():
+        for u in user_summaries(db):
+            u.update(presence.fields(u['username']))
+            yield u
+
+    version = (response_cache.version(('users', None)), presence.version())
+    return cached_listing(('users', None), version, 'users', users)
 
 ##########################
 # Profil Güncelleme (GIF Avatar / Banner)
@@ -273,19 +3473,22 @@ def update_profile():
     data = request.get_json()
     new_avatar = data.get('avatar_url', None)
     new_banner = data.get('banner_url', None)
+    fields = {}
 
     if new_avatar:
         if not (new_avatar.startswith("http://") or new_avatar.startswith("https://")):
             return jsonify({"status":"error","message":"Invalid avatar URL"}),400
-        cu['avatar_url'] = new_avatar
+        fields['avatar_url'] = new_avatar
 
     if new_banner:
         if not (new_banner.startswith("http://") or new_banner.startswith("https://")):
             return jsonify({"status":"error","message":"Invalid banner URL"}),400
         # banner_url alanını ekleyelim (yoksa ek oluştur)
-        cu['banner_url'] = new_banner
+        fields['banner_url'] = new_banner
 
-    save_db(db)
+    if fields:
+        commit('update_user', username=cu['username'], fields=fields)
+        publish_event('user_update', fields, user=cu['username'])
     return jsonify({"status":"success","message":"Profile updated"})
 
 ##########################
@@ -314,17 +3517,18 @@ def send_friend_request():
     if to_user['username'] in from_user['friends']:
         return jsonify({"status":"error","message":"Already friends"}),400
 
-    for fr in db['friend_requests']:
-        if fr['from'] == from_user['username'] and fr['to'] == to_user['username']:
-            return jsonify({"status":"error","message":"Request already sent"}),400
+    if friend_request_exists(db, from_user['username'], to_user['username']):
+        return jsonify({"status":"error","message":"Request already sent"}),400
 
     new_req = {
         "id": str(uuid.uuid4()),
         "from": from_user['username'],
         "to": to_user['username']
     }
-    db['friend_requests'].append(new_req)
-    save_db(db)
+    if not commit('add_friend_request', request=new_req):
+        return jsonify({"status":"error","message":"Request already sent"}),400
+    for username in (new_req['from'], new_req['to']):
+        publish_event('friend_request_create', {"request": new_req}, user=username)
     return jsonify({"status":"success","message":"Friend request sent"})
 
 
@@ -340,7 +3544,7 @@ def friend_requests():
     if not user:
         return jsonify({"status":"error","message":"Invalid token"}),401
 
-    incoming = [fr for fr in db['friend_requests'] if fr['to'] == user['username']]
+    incoming = incoming_friend_requests(db, user['username'])
     return jsonify({"friend_requests": incoming})
 
 
@@ -360,14 +3564,7 @@ def respond_friend_request():
     data = request.get_json()
     req_id = data.get('request_id')
     action = data.get('action')
-    fr_index = None
-    fr = None
-    for i, r in enumerate(db['friend_requests']):
-        if r['id'] == req_id:
-            fr = r
-            fr_index = i
-            break
-
+    fr = find_friend_request(db, req_id)
     if not fr:
         return jsonify({"status":"error","message":"Request not found"}),404
 
@@ -375,16 +3572,16 @@ def respond_friend_request():
         return jsonify({"status":"error","message":"Not your request"}),403
 
     if action == "accept":
-        from_user = find_user(db, fr['from'])
-        to_user = current_user
-        from_user['friends'].append(to_user['username'])
-        to_user['friends'].append(from_user['username'])
-        del db['friend_requests'][fr_index]
-        save_db(db)
+        commit('add_friendship', user_a=fr['from'], user_b=current_user['username'])
+        commit('remove_friend_request', request_id=req_id)
+        for username in (fr['from'], fr['to']):
+            publish_event('friend_add', {"request_id": req_id, "users": [fr['from'], fr['to']]},
+                          user=username)
         return jsonify({"status":"success","message":"Friend added"})
     elif action == "reject":
-        del db['friend_requests'][fr_index]
-        save_db(db)
+        commit('remove_friend_request', request_id=req_id)
+        for username in (fr['from'], fr['to']):
+            publish_event('friend_request_delete', {"request_id": req_id}, user=username)
         return jsonify({"status":"success","message":"Friend request rejected"})
     else:
         return jsonify({"status":"error","message":"Invalid action"}),400
@@ -403,10 +3600,9 @@ def friends_list():
 
     friends_data = []
     for f in user['friends']:
-        fu = find_user(db, f)
         friends_data.append({
-            "username": fu['username'],
-            "online": fu['online']
+            "username": f,
+            **presence.fields(f)
         })
     return jsonify({"friends": friends_data})
 
@@ -436,9 +3632,9 @@ def create_dm():
     if other_user['username'] not in current_user['friends']:
         return jsonify({"status":"error","message":"You can only DM friends"}),403
 
-    for dm in db['direct_messages']:
-        if set(dm['participants']) == set([current_user['username'], other_user['username']]):
-            return jsonify({"status":"success","dm_id":dm['id'],"message":"DM already exists"})
+    dm = find_dm_between(db, current_user['username'], other_user['username'])
+    if dm:
+        return jsonify({"status":"success","dm_id":dm['id'],"message":"DM already exists"})
 
     dm_id = str(uuid.uuid4())
     new_dm = {
@@ -446,10 +3642,12 @@ def create_dm():
         "participants": [current_user['username'], other_user['username']],
         "messages": []
     }
-    db['direct_messages'].append(new_dm)
-    current_user['dm_channels'].append(dm_id)
-    other_user['dm_channels'].append(dm_id)
-    save_db(db)
+    commit('add_dm', dm=new_dm)
+    commit('add_user_dm', username=current_user['username'], dm_id=dm_id)
+    commit('add_user_dm', username=other_user['username'], dm_id=dm_id)
+    # Katılımcılar yeni DM'in konusuna henüz abone değil; olay kullanıcı konularına gider
+    for username in new_dm['participants']:
+        publish_event('dm_create', {"dm_id": dm_id, "participants": new_dm['participants']}, user=username)
     return jsonify({"status":"success","dm_id":dm_id})
 
 # /send_dm [POST]
@@ -476,16 +3674,24 @@ def send_dm():
     if cu['username'] not in dm_obj['participants']:
         return jsonify({"status":"error","message":"Not a participant"}),403
 
-    msg_id = str(uuid.uuid4())
+    file_hash = None
+    if file_base64:
+        file_data = decode_upload(file_base64)
+        if file_data is None:
+            return jsonify({"status":"error","message":"Invalid file"}),400
+        file_hash = blob_store.put(file_data)
+
+    msg_id = new_id()
     dm_msg = {
         "id": msg_id,
         "author": cu['username'],
         "content": content,
-        "timestamp": datetime.utcnow().isoformat(),
-        "file_base64": file_base64
+        # Zaman kimlikten türetilir; kimlik sırası ile zaman sırası aynı kalır
+        "timestamp": snowflake_datetime(msg_id).isoformat(),
+        "file_hash": file_hash
     }
-    dm_obj['messages'].append(dm_msg)
-    save_db(db)
+    commit('add_dm_message', dm_id=dm_id, message=dm_msg)
+    publish_event('dm_message_create', {"message": dm_msg}, dm_id=dm_id)
     return jsonify({"status":"success","message_id":msg_id})
 
 # /dm_messages/<dm_id> [GET]
@@ -507,7 +3713,19 @@ def dm_messages(dm_id):
     if cu['username'] not in dm_obj['participants']:
         return jsonify({"status":"error","message":"Not participant"}),403
 
-    return jsonify({"messages": dm_obj['messages']})
+    limit = parse_limit()
+    if limit is None:
+        return jsonify({"status":"error","message":"Invalid limit"}),400
+    page = dm_messages_page(db, dm_id, limit,
+                            before=request.args.get('before'), after=request.args.get('after'))
+    if page is None:
+        return jsonify({"status":"error","message":"Invalid cursor"}),400
+    msgs, has_more = page
+
+    # Mobil istemciler ek dosyaları ayrıca yükleyebilsin diye gövdeler isteğe bağlı
+    if request.args.get('include_files', '1') in ('0', 'false'):
+        msgs = [without_file_body(m) for m in msgs]
+    return jsonify({"messages": msgs, "has_more": has_more})
 
 # /edit_dm_message [POST]
 # {"dm_id":"...","message_id":"...","new_content":"..."}
@@ -535,19 +3753,15 @@ def edit_dm_message():
     if cu['username'] not in dm_obj['participants']:
         return jsonify({"status":"error","message":"Not participant"}),403
 
-    msg = None
-    for m in dm_obj['messages']:
-        if m['id'] == message_id:
-            msg = m
-            break
+    msg = find_dm_message(db, dm_id, message_id)
     if not msg:
         return jsonify({"status":"error","message":"Message not found"}),404
 
     if msg['author'] != cu['username']:
         return jsonify({"status":"error","message":"No permission"}),403
 
-    msg['content'] = new_content
-    save_db(db)
+    commit('edit_dm_message', dm_id=dm_id, message_id=message_id, content=new_content)
+    publish_event('dm_message_update', {"message_id": message_id, "content": new_content}, dm_id=dm_id)
     return jsonify({"status":"success","message":"DM message edited"})
 
 
@@ -576,20 +3790,15 @@ def delete_dm_message():
     if cu['username'] not in dm_obj['participants']:
         return jsonify({"status":"error","message":"Not participant"}),403
 
-    msg_index = None
-    for i,m in enumerate(dm_obj['messages']):
-        if m['id'] == message_id:
-            msg_index = i
-            break
-    if msg_index is None:
+    msg = find_dm_message(db, dm_id, message_id)
+    if not msg:
         return jsonify({"status":"error","message":"Message not found"}),404
 
-    msg = dm_obj['messages'][msg_index]
     if msg['author'] != cu['username']:
         return jsonify({"status":"error","message":"No permission"}),403
 
-    del dm_obj['messages'][msg_index]
-    save_db(db)
+    commit('delete_dm_message', dm_id=dm_id, message_id=message_id)
+    publish_event('dm_message_delete', {"message_id": message_id}, dm_id=dm_id)
     return jsonify({"status":"success","message":"DM message deleted"})
 
 ##########################
@@ -635,26 +3844,18 @@ def create_guild():
         "bans": []
     }
 
-    db['guilds'].append(new_guild)
-    if guild_id not in creator['guilds']:
-        creator['guilds'].append(guild_id)
+    commit('add_guild', guild=new_guild)
+    commit('add_user_guild', username=creator['username'], guild_id=guild_id)
+    publish_event('guild_create', {"guild_id": guild_id, "name": guild_name}, user=creator['username'])
     add_audit_log(new_guild, "CREATE_GUILD", creator['username'], f"Guild {guild_name} created")
-    save_db(db)
     return jsonify({"status":"success","guild_id":guild_id})
 
 # /guilds [GET]
 @app.route('/guilds', methods=['GET'])
 def list_guilds():
     db = load_db()
-    guild_info = []
-    for g in db['guilds']:
-        guild_info.append({
-            "id": g['id'],
-            "name": g['name'],
-            "owner": g['owner'],
-            "member_count": len(g['members'])
-        })
-    return jsonify({"guilds": guild_info})
+    return cached_listing(('guilds', None), response_cache.version(('guilds', None)),
+                          'guilds', lambda: guild_summaries(db))
 
 # /guild/<guild_id> [GET]
 @app.route('/guild/<guild_id>', methods=['GET'])
@@ -663,16 +3864,41 @@ def get_guild(guild_id):
     guild = find_guild(db, guild_id)
     if not guild:
         return jsonify({"status":"error","message":"Guild not found"}),404
-    return jsonify({
+    version = (response_cache.version(('guild', guild_id)), voice_state.version(guild_id))
+    return cached_json(('guild', guild_id), version, lambda: {
         "id": guild['id'],
         "name": guild['name'],
         "owner": guild['owner'],
         "roles": [r['name'] for r in guild['roles']],
         "categories": guild['categories'],
-        "channels": guild['channels'],
+        "channels": [with_voice_state(guild['id'], ch) for ch in guild['channels']],
         "member_count": len(guild['members'])
     })
 
+# /guild/<guild_id>/voice_states [GET]
+# Sunucudaki ses bağlantıları (kim hangi ses kanalında)
+@app.route('/guild/<guild_id>/voice_states', methods=['GET'])
+def get_guild_voice_states(guild_id):
+    db = load_db()
+    guild = find_guild(db, guild_id)
+    if not guild:
+        return jsonify({"status":"error","message":"Guild not found"}),404
+    return jsonify({"voice_states": voice_state.guild_states(guild_id)})
+
+# /guild/<guild_id>/emojis [GET]
+# Emoji listesi; görsel baytları yerine /emoji/<id> için özet döner.
+@app.route('/guild/<guild_id>/emojis', methods=['GET'])
+def get_guild_emojis(guild_id):
+    db = load_db()
+    guild = find_guild(db, guild_id)
+    if not guild:
+        return jsonify({"status":"error","message":"Guild not found"}),404
+    return jsonify({"emojis": [{
+        "id": e['id'],
+        "name": e['name'],
+        "hash": emoji_image_hash(e)
+    } for e in guild['emojis']]})
+
 # /create_category [POST]
 # {"guild_id":"...","name":"..."}
 @app.route('/create_category', methods=['POST'])
@@ -698,12 +3924,12 @@ def create_category():
         return jsonify({"status":"error","message":"No permission"}),403
 
     cat_id = str(uuid.uuid4())
-    guild['categories'].append({
+    commit('add_category', guild_id=guild_id, category={
         "id": cat_id,
         "name": name
     })
+    publish_event('category_create', {"category": {"id": cat_id, "name": name}}, guild=guild)
     add_audit_log(guild, "CREATE_CATEGORY", user['username'], f"Category {name}")
-    save_db(db)
     return jsonify({"status":"success","category_id":cat_id})
 
 # /create_channel [POST]
@@ -748,9 +3974,9 @@ def create_channel():
         "allowed_roles": allowed_roles,
         "type": "text"  # Default text channel
     }
-    guild['channels'].append(new_channel)
+    commit('add_channel', guild_id=guild_id, channel=new_channel)
+    publish_event('channel_create', {"channel": new_channel}, guild=guild, channel=new_channel)
     add_audit_log(guild, "CREATE_CHANNEL", user['username'], f"Channel {name}")
-    save_db(db)
     return jsonify({"status":"success","channel_id":ch_id})
 
 ##########################
@@ -802,9 +4028,9 @@ def create_voice_channel():
             "user": None
         }
     }
-    guild['channels'].append(new_voice_channel)
+    commit('add_channel', guild_id=guild_id, channel=new_voice_channel)
+    publish_event('channel_create', {"channel": new_voice_channel}, guild=guild, channel=new_voice_channel)
     add_audit_log(guild, "CREATE_VOICE_CHANNEL", user['username'], f"Voice channel {name}")
-    save_db(db)
     return jsonify({"status":"success","voice_channel_id":vc_id})
 
 @app.route('/join_voice_channel', methods=['POST'])
@@ -824,31 +4050,20 @@ def join_voice_channel():
     data = request.get_json()
     channel_id = data.get('channel_id')
     
-    ch_guild = None
-    ch_obj = None
-    for g in db['guilds']:
-        for c in g['channels']:
-            if c['id'] == channel_id and c.get('type') == 'voice':
-                ch_guild = g
-                ch_obj = c
-                break
-        if ch_obj:
-            break
+    ch_guild, ch_obj = resolve_channel(db, channel_id, 'voice')
     
     if not ch_obj:
         return jsonify({"status":"error","message":"Voice channel not found"}),404
     
-    if not user_in_guild(ch_guild, cu['username']):
+    if not is_guild_member(ch_guild, cu['username']):
         return jsonify({"status":"error","message":"Not in guild"}),403
 
-    if ch_obj.get('is_private'):
-        member = user_in_guild(ch_guild, cu['username'])
-        if not any(r in ch_obj.get('allowed_roles', []) for r in member['roles']):
-            return jsonify({"status":"error","message":"No access to this voice channel"}),403
+    if not user_has_access_to_channel(ch_guild, cu, ch_obj):
+        return jsonify({"status":"error","message":"No access to this voice channel"}),403
     
-    if cu['username'] not in ch_obj['connected_users']:
-        ch_obj['connected_users'].append(cu['username'])
-    save_db(db)
+    if voice_state.join(ch_guild['id'], channel_id, cu['username']):
+        publish_event('voice_join', {"channel_id": channel_id, "username": cu['username']},
+                      guild=ch_guild, channel=ch_obj)
     return jsonify({"status":"success","message":"Joined voice channel"})
 
 @app.route('/leave_voice_channel', methods=['POST'])
@@ -868,23 +4083,14 @@ def leave_voice_channel():
     data = request.get_json()
     channel_id = data.get('channel_id')
 
-    ch_guild = None
-    ch_obj = None
-    for g in db['guilds']:
-        for c in g['channels']:
-            if c['id'] == channel_id and c.get('type') == 'voice':
-                ch_guild = g
-                ch_obj = c
-                break
-        if ch_obj:
-            break
+    ch_guild, ch_obj = resolve_channel(db, channel_id, 'voice')
     
     if not ch_obj:
         return jsonify({"status":"error","message":"Voice channel not found"}),404
 
-    if cu['username'] in ch_obj['connected_users']:
-        ch_obj['connected_users'].remove(cu['username'])
-    save_db(db)
+    if voice_state.leave(ch_guild['id'], channel_id, cu['username']):
+        publish_event('voice_leave', {"channel_id": channel_id, "username": cu['username']},
+                      guild=ch_guild, channel=ch_obj)
     return jsonify({"status":"success","message":"Left voice channel"})
 
 @app.route('/start_screen_share', methods=['POST'])
@@ -904,28 +4110,21 @@ def start_screen_share():
     data = request.get_json()
     channel_id = data.get('channel_id')
 
-    ch_guild = None
-    ch_obj = None
-    for g in db['guilds']:
-        for c in g['channels']:
-            if c['id'] == channel_id and c.get('type') == 'voice':
-                ch_guild = g
-                ch_obj = c
-                break
-        if ch_obj:
-            break
+    ch_guild, ch_obj = resolve_channel(db, channel_id, 'voice')
     if not ch_obj:
         return jsonify({"status":"error","message":"Voice channel not found"}),404
 
-    if cu['username'] not in ch_obj['connected_users']:
+    if not voice_state.is_connected(ch_guild['id'], channel_id, cu['username']):
         return jsonify({"status":"error","message":"You are not in this voice channel"}),403
 
-    ch_obj['screen_share'] = {
+    screen_share = {
         "active": True,
         "user": cu['username'],
         "started_at": datetime.utcnow().isoformat()
     }
-    save_db(db)
+    voice_state.set_screen_share(ch_guild['id'], channel_id, screen_share)
+    publish_event('screen_share_update', {"channel_id": channel_id, "screen_share": screen_share},
+                  guild=ch_guild, channel=ch_obj)
     return jsonify({"status":"success","message":"Screen share started"})
 
 @app.route('/stop_screen_share', methods=['POST'])
@@ -945,28 +4144,20 @@ def stop_screen_share():
     data = request.get_json()
     channel_id = data.get('channel_id')
     
-    ch_guild = None
-    ch_obj = None
-    for g in db['guilds']:
-        for c in g['channels']:
-            if c['id'] == channel_id and c.get('type') == 'voice':
-                ch_guild = g
-                ch_obj = c
-                break
-        if ch_obj:
-            break
+    ch_guild, ch_obj = resolve_channel(db, channel_id, 'voice')
     if not ch_obj:
         return jsonify({"status":"error","message":"Voice channel not found"}),404
     
-    scr_share = ch_obj.get('screen_share')
-    if not scr_share or not scr_share.get('active'):
+    scr_share = voice_state.screen_share(ch_guild['id'], channel_id)
+    if not scr_share.get('active'):
         return jsonify({"status":"error","message":"No active screen share"}),400
 
     if scr_share['user'] != cu['username']:
         return jsonify({"status":"error","message":"You are not the one sharing"}),403
 
-    ch_obj['screen_share'] = {"active": False, "user": None}
-    save_db(db)
+    voice_state.set_screen_share(ch_guild['id'], channel_id, None)
+    publish_event('screen_share_update', {"channel_id": channel_id, "screen_share": {"active": False, "user": None}},
+                  guild=ch_guild, channel=ch_obj)
     return jsonify({"status":"success","message":"Screen share stopped"})
 
 ##########################
@@ -1005,7 +4196,7 @@ def invite_create():
     if not ch:
         return jsonify({"status":"error","message":"Channel not found"}),404
 
-    inv_id = str(uuid.uuid4())
+    inv_id = new_id()
     expires_at = (datetime.utcnow() + timedelta(seconds=expires_in)).isoformat() if expires_in else None
     new_invite = {
         "id": inv_id,
@@ -1015,9 +4206,9 @@ def invite_create():
         "uses": 0,
         "max_uses": max_uses
     }
-    guild['invites'].append(new_invite)
+    commit('add_invite', guild_id=guild_id, invite=new_invite)
+    publish_event('invite_create', {"invite": new_invite}, guild=guild)
     add_audit_log(guild, "CREATE_INVITE", user['username'], f"Invite {inv_id}")
-    save_db(db)
     return jsonify({"status":"success","invite_id":inv_id})
 
 # /join_by_invite [POST]
@@ -1038,37 +4229,33 @@ def join_by_invite():
     data = request.get_json()
     inv_id = data.get('invite_id')
 
-    found_inv = None
-    found_guild = None
-    for g in db['guilds']:
-        for inv in g['invites']:
-            if inv['id'] == inv_id:
-                found_inv = inv
-                found_guild = g
-                break
-        if found_inv:
-            break
+    found_guild, found_inv = find_invite(db, inv_id)
 
     if not found_inv:
         return jsonify({"status":"error","message":"Invite not found"}),404
 
-    if not invite_valid(found_inv):
-        return jsonify({"status":"error","message":"Invite invalid or expired"}),400
+    # Kontroller kilit altında güncel veriyle tekrarlanır; aynı anda gelen iki
+    # katılım ne daveti fazla kullanır ne de üyeyi iki kez ekler
+    with partition_locks.hold(('guild', found_guild['id']), ('user', user['username'])):
+        found_guild, found_inv = find_invite(db, inv_id)
 
-    if user_in_guild(found_guild, user['username']):
-        return jsonify({"status":"error","message":"Already in guild"}),400
+        if not invite_valid(found_inv):
+            return jsonify({"status":"error","message":"Invite invalid or expired"}),400
 
-    found_guild['members'].append({
-        "username": user['username'],
-        "roles": ["member"],
-        "joined_at": datetime.utcnow().isoformat()
-    })
-    if found_guild['id'] not in user['guilds']:
-        user['guilds'].append(found_guild['id'])
+        if is_guild_member(found_guild, user['username']):
+            return jsonify({"status":"error","message":"Already in guild"}),400
 
-    found_inv['uses'] += 1
-    add_audit_log(found_guild, "GUILD_JOIN", user['username'], f"Joined via invite {inv_id}")
-    save_db(db)
+        member = {
+            "username": user['username'],
+            "roles": ["member"],
+            "joined_at": datetime.utcnow().isoformat()
+        }
+        commit('add_member', guild_id=found_guild['id'], member=member)
+        publish_event('member_join', {"member": member}, guild=found_guild)
+        commit('add_user_guild', username=user['username'], guild_id=found_guild['id'])
+
+        commit('use_invite', guild_id=found_guild['id'], invite_id=inv_id)
+        add_audit_log(found_guild, "GUILD_JOIN", user['username'], f"Joined via invite {inv_id}")
     return jsonify({"status":"success","message":"Joined guild"})
 
 ##########################
@@ -1095,55 +4282,57 @@ def send_message():
     content = data.get('content')
     file_base64 = data.get('file_base64', None)
 
-    ch_guild = None
-    ch_obj = None
-    for g in db['guilds']:
-        for c in g['channels']:
-            if c['id'] == channel_id:
-                ch_guild = g
-                ch_obj = c
-                break
-        if ch_obj:
-            break
+    ch_guild, ch_obj = resolve_channel(db, channel_id)
 
     if not ch_obj:
         return jsonify({"status":"error","message":"Channel not found"}),404
 
-    if not user_in_guild(ch_guild, cu['username']):
+    if not is_guild_member(ch_guild, cu['username']):
         return jsonify({"status":"error","message":"Not in guild"}),403
 
     if not user_has_access_to_channel(ch_guild, cu, ch_obj):
         return jsonify({"status":"error","message":"No access to this channel"}),403
 
-    msg_id = str(uuid.uuid4())
+    file_hash = None
+    if file_base64:
+        file_data = decode_upload(file_base64)
+        if file_data is None:
+            return jsonify({"status":"error","message":"Invalid file"}),400
+        file_hash = blob_store.put(file_data)
+
+    msg_id = new_id()
     new_msg = {
         "id": msg_id,
         "channel_id": channel_id,
         "author": cu['username'],
         "content": content,
-        "timestamp": datetime.utcnow().isoformat(),
-        "file_base64": file_base64,
+        # Zaman kimlikten türetilir; kimlik sırası ile zaman sırası aynı kalır
+        "timestamp": snowflake_datetime(msg_id).isoformat(),
+        "file_hash": file_hash,
         "pinned": False,
         "reactions": []
     }
-    db['messages'].append(new_msg)
-    save_db(db)
+    commit('add_message', message=new_msg)
+    publish_event('message_create', {"message": new_msg}, guild=ch_guild, channel=ch_obj)
     return jsonify({"status":"success","message_id":msg_id})
 
+# /attachments/<file_hash> [GET]
+# Eki ham bayt olarak akıtır; Range, ETag ve Content-Length desteklenir.
+@app.route('/attachments/<file_hash>', methods=['GET'])
+def get_attachment(file_hash):
+    if not re.fullmatch(r'[0-9a-f]{64}', file_hash) or not blob_store.exists(file_hash):
+        return jsonify({"status":"error","message":"Attachment not found"}),404
+    # İçerik özeti değişmez; istemci sonsuza kadar önbelleğe alabilir
+    resp = send_file(os.path.abspath(blob_store.path(file_hash)), mimetype='application/octet-stream',
+                     conditional=True, etag=file_hash, max_age=31536000)
+    resp.cache_control.immutable = True
+    return resp
+
 # /messages/<channel_id> [GET]
 @app.route('/messages/<channel_id>', methods=['GET'])
 def get_messages(channel_id):
     db = load_db()
-    ch_guild = None
-    ch_obj = None
-    for g in db['guilds']:
-        for c in g['channels']:
-            if c['id'] == channel_id:
-                ch_guild = g
-                ch_obj = c
-                break
-        if ch_obj:
-            break
+    ch_guild, ch_obj = resolve_channel(db, channel_id)
 
     if not ch_obj:
         return jsonify({"status":"error","message":"Channel not found"}),404
@@ -1159,13 +4348,25 @@ def get_messages(channel_id):
         cu = find_user_by_token(db, token)
         if not cu:
             return jsonify({"status":"error","message":"Invalid token"}),401
-        if not user_in_guild(ch_guild, cu['username']):
+        if not is_guild_member(ch_guild, cu['username']):
             return jsonify({"status":"error","message":"Not in guild"}),403
         if not user_has_access_to_channel(ch_guild, cu, ch_obj):
             return jsonify({"status":"error","message":"No access"}),403
 
-    msgs = [m for m in db['messages'] if m['channel_id'] == channel_id]
-    return jsonify({"messages": msgs})
+    limit = parse_limit()
+    if limit is None:
+        return jsonify({"status":"error","message":"Invalid limit"}),400
+    before, after = request.args.get('before'), request.args.get('after')
+
+    def build():
+        page = channel_messages(db, channel_id, limit, before=before, after=after)
+        if page is None:
+            return jsonify({"status":"error","message":"Invalid cursor"}),400
+        msgs, has_more = page
+        return {"messages": msgs, "has_more": has_more}
+
+    return cached_json(('messages', channel_id, limit, before, after),
+                       response_cache.version(('messages', channel_id)), build)
 
 # /edit_message [POST]
 # {"message_id":"...","new_content":"..."}
@@ -1188,18 +4389,9 @@ def edit_message():
     if not msg:
         return jsonify({"status":"error","message":"Message not found"}),404
 
-    ch_guild = None
-    ch_obj = None
-    for g in db['guilds']:
-        for c in g['channels']:
-            if c['id'] == msg['channel_id']:
-                ch_guild = g
-                ch_obj = c
-                break
-        if ch_obj:
-            break
+    ch_guild, ch_obj = resolve_channel(db, msg['channel_id'])
 
-    if not user_in_guild(ch_guild, cu['username']):
+    if not is_guild_member(ch_guild, cu['username']):
         return jsonify({"status":"error","message":"Not in guild"}),403
 
     if not user_has_access_to_channel(ch_guild, cu, ch_obj):
@@ -1209,8 +4401,9 @@ def edit_message():
     if msg['author'] != cu['username'] and not user_has_permission(ch_guild, cu['username'], "manage_channels"):
         return jsonify({"status":"error","message":"No permission"}),403
 
-    msg['content'] = new_content
-    save_db(db)
+    commit('edit_message', message_id=message_id, content=new_content)
+    publish_event('message_update', {"message_id": message_id, "channel_id": ch_obj['id'], "content": new_content},
+                  guild=ch_guild, channel=ch_obj)
     return jsonify({"status":"success","message":"Message edited"})
 
 # /delete_message [POST]
@@ -1228,28 +4421,13 @@ def delete_message():
 
     data = request.get_json()
     message_id = data.get('message_id')
-    msg_index = None
-    msg_obj = None
-    for i,m in enumerate(db['messages']):
-        if m['id'] == message_id:
-            msg_index = i
-            msg_obj = m
-            break
-    if msg_index is None:
+    msg_obj = message_belongs_to_channel(db, message_id)
+    if not msg_obj:
         return jsonify({"status":"error","message":"Message not found"}),404
 
-    ch_guild = None
-    ch_obj = None
-    for g in db['guilds']:
-        for c in g['channels']:
-            if c['id'] == msg_obj['channel_id']:
-                ch_guild = g
-                ch_obj = c
-                break
-        if ch_obj:
-            break
+    ch_guild, ch_obj = resolve_channel(db, msg_obj['channel_id'])
 
-    if not user_in_guild(ch_guild, cu['username']):
+    if not is_guild_member(ch_guild, cu['username']):
         return jsonify({"status":"error","message":"Not in guild"}),403
 
     if not user_has_access_to_channel(ch_guild, cu, ch_obj):
@@ -1258,8 +4436,9 @@ def delete_message():
     if msg_obj['author'] != cu['username'] and not user_has_permission(ch_guild, cu['username'], "manage_channels"):
         return jsonify({"status":"error","message":"No permission"}),403
 
-    del db['messages'][msg_index]
-    save_db(db)
+    commit('delete_message', message_id=message_id)
+    publish_event('message_delete', {"message_id": message_id, "channel_id": ch_obj['id']},
+                  guild=ch_guild, channel=ch_obj)
     return jsonify({"status":"success","message":"Message deleted"})
 
 # /pin_message [POST]
@@ -1281,38 +4460,72 @@ def pin_message():
     if not msg:
         return jsonify({"status":"error","message":"Message not found"}),404
 
-    ch_guild = None
-    ch_obj = None
-    for g in db['guilds']:
-        for c in g['channels']:
-            if c['id'] == msg['channel_id']:
-                ch_guild = g
-                ch_obj = c
-                break
-        if ch_obj:
-            break
+    ch_guild, ch_obj = resolve_channel(db, msg['channel_id'])
 
-    if not user_in_guild(ch_guild, cu['username']):
+    if not is_guild_member(ch_guild, cu['username']):
         return jsonify({"status":"error","message":"Not in guild"}),403
 
     if not user_has_permission(ch_guild, cu['username'], "manage_channels"):
         return jsonify({"status":"error","message":"No permission"}),403
 
-    msg['pinned'] = True
-    save_db(db)
+    commit('pin_message', message_id=message_id)
+    publish_event('message_pin', {"message_id": message_id, "channel_id": ch_obj['id']},
+                  guild=ch_guild, channel=ch_obj)
     return jsonify({"status":"success","message":"Message pinned"})
 
 # /search_messages [GET]
 # query params: q=...
 @app.route('/search_messages', methods=['GET'])
 def search_messages():
+    """
+    Query: q, guild_id, channel_id, author, sort=relevance|recent, limit, offset.
+    Private kanallardaki mesajlar yalnızca erişimi olan kullanıcıya döner.
+    """
     db = load_db()
-    q = request.args.get('q', "")
+    cu = None
+    auth = request.headers.get('Authorization')
+    if auth and auth.startswith("Bearer "):
+        cu = find_user_by_token(db, auth.split(" ")[1])
+        if not cu:
+            return jsonify({"status":"error","message":"Invalid token"}),401
+
+    terms = search_terms(request.args.get('q', ""))
+    if not terms:
+        return jsonify({"status":"error","message":"Invalid query"}),400
+    sort = request.args.get('sort', 'relevance')
+    if sort not in ('relevance', 'recent'):
+        return jsonify({"status":"error","message":"Invalid sort"}),400
+    limit = parse_limit(default=25)
+    if limit is None:
+        return jsonify({"status":"error","message":"Invalid limit"}),400
+    try:
+        offset = int(request.args.get('offset', 0))
+    except ValueError:
+        offset = -1
+    if offset < 0:
+        return jsonify({"status":"error","message":"Invalid offset"}),400
+
+    guild_id = request.args.get('guild_id')
+    channel_id = request.args.get('channel_id')
+    readable = {}
+
+    def visible(ch_id):
+        if channel_id and ch_id != channel_id:
+            return False
+        if ch_id not in readable:
+            ch_guild, ch_obj = resolve_channel(db, ch_id)
+            readable[ch_id] = bool(ch_obj) and (not guild_id or ch_guild['id'] == guild_id) \
+                and channel_readable(ch_guild, cu, ch_obj)
+        return readable[ch_id]
+
+    search_index.ensure_built(db)
+    ids = search_index.search(terms, visible, author=request.args.get('author'), sort=sort)
     results = []
-    for m in db['messages']:
-        if q.lower() in m['content'].lower():
+    for mid in ids[offset:offset + limit]:
+        m = message_belongs_to_channel(db, mid)
+        if m:
             results.append(m)
-    return jsonify({"results": results})
+    return jsonify({"results": results, "total": len(ids)})
 
 # /add_reaction [POST]
 # {"message_id":"...","emoji_id":"..."}
@@ -1335,38 +4548,19 @@ def add_reaction():
     if not msg:
         return jsonify({"status":"error","message":"Message not found"}),404
 
-    ch_guild = None
-    ch_obj = None
-    for g in db['guilds']:
-        for c in g['channels']:
-            if c['id'] == msg['channel_id']:
-                ch_guild = g
-                ch_obj = c
-                break
-        if ch_obj:
-            break
+    ch_guild, ch_obj = resolve_channel(db, msg['channel_id'])
 
-    if not user_in_guild(ch_guild, cu['username']):
+    if not is_guild_member(ch_guild, cu['username']):
         return jsonify({"status":"error","message":"Not in guild"}),403
 
-    emoji = find_emoji(ch_guild, emoji_id)
+    emoji = find_guild_emoji(db, ch_guild['id'], emoji_id)
     if not emoji:
         return jsonify({"status":"error","message":"Emoji not found"}),404
 
-    found_reaction = None
-    for r in msg['reactions']:
-        if r['emoji_id'] == emoji_id:
-            found_reaction = r
-            break
-    if found_reaction:
-        if cu['username'] not in found_reaction['users']:
-            found_reaction['users'].append(cu['username'])
-    else:
-        msg['reactions'].append({
-            "emoji_id": emoji_id,
-            "users": [cu['username']]
-        })
-    save_db(db)
+    commit('add_reaction', message_id=message_id, emoji_id=emoji_id, username=cu['username'])
+    publish_event('reaction_add', {"message_id": message_id, "channel_id": ch_obj['id'],
+                                   "emoji_id": emoji_id, "username": cu['username']},
+                  guild=ch_guild, channel=ch_obj)
     return jsonify({"status":"success","message":"Reaction added"})
 
 # /remove_reaction [POST]
@@ -1390,14 +4584,7 @@ def remove_reaction():
     if not msg:
         return jsonify({"status":"error","message":"Message not found"}),404
 
-    ch_guild = None
-    for g in db['guilds']:
-        for c in g['channels']:
-            if c['id'] == msg['channel_id']:
-                ch_guild = g
-                break
-        if ch_guild:
-            break
+    ch_guild, ch_obj = resolve_channel(db, msg['channel_id'])
 
     found_reaction = None
     for r in msg['reactions']:
@@ -1408,10 +4595,10 @@ def remove_reaction():
         return jsonify({"status":"error","message":"Reaction not found"}),404
 
     if cu['username'] in found_reaction['users']:
-        found_reaction['users'].remove(cu['username'])
-        if len(found_reaction['users']) == 0:
-            msg['reactions'].remove(found_reaction)
-        save_db(db)
+        commit('remove_reaction', message_id=message_id, emoji_id=emoji_id, username=cu['username'])
+        publish_event('reaction_remove', {"message_id": message_id, "channel_id": ch_obj['id'],
+                                          "emoji_id": emoji_id, "username": cu['username']},
+                      guild=ch_guild, channel=ch_obj)
         return jsonify({"status":"success","message":"Reaction removed"})
     else:
         return jsonify({"status":"error","message":"You did not react"}),400
@@ -1445,16 +4632,45 @@ def add_emoji():
     if not user_has_permission(guild, cu['username'], "manage_guild"):
         return jsonify({"status":"error","message":"No permission"}),403
 
+    image = decode_upload(image_base64) if image_base64 else None
+    if not image:
+        return jsonify({"status":"error","message":"Invalid image"}),400
+
     emoji_id = str(uuid.uuid4())
-    guild['emojis'].append({
+    emoji = {
         "id": emoji_id,
         "name": name,
-        "image_base64": image_base64
-    })
+        "image_hash": blob_store.put(image)
+    }
+    commit('add_emoji', guild_id=guild_id, emoji=emoji)
+    publish_event('emoji_create', {"emoji": {"id": emoji_id, "name": name, "hash": emoji['image_hash']}}, guild=guild)
     add_audit_log(guild, "ADD_EMOJI", cu['username'], f"Emoji {name}")
-    save_db(db)
     return jsonify({"status":"success","emoji_id":emoji_id})
 
+# /emoji/<emoji_id> [GET]
+# Emoji görselini ham bayt olarak döner; ETag görselin sha256 özetidir.
+@app.route('/emoji/<emoji_id>', methods=['GET'])
+def get_emoji(emoji_id):
+    db = load_db()
+    emoji = find_emoji_by_id(db, emoji_id)
+    if not emoji:
+        return jsonify({"status":"error","message":"Emoji not found"}),404
+    digest = emoji_image_hash(emoji)
+    if not digest:
+        return jsonify({"status":"error","message":"Emoji image not found"}),404
+    if emoji.get('image_hash'):
+        if not blob_store.exists(digest):
+            return jsonify({"status":"error","message":"Emoji not found"}),404
+        with open(blob_store.path(digest), 'rb') as f:
+            data = f.read()
+    else:
+        data = decode_upload(emoji['image_base64'])
+    # Bir emojinin görseli değişmez; istemci uzun süre önbellekte tutabilir
+    resp = send_file(io.BytesIO(data), mimetype=image_mimetype(data),
+                     conditional=True, etag=digest, max_age=31536000)
+    resp.cache_control.immutable = True
+    return resp
+
 # /remove_emoji [POST]
 # {"guild_id":"...","emoji_id":"..."}
 @app.route('/remove_emoji', methods=['POST'])
@@ -1479,23 +4695,25 @@ def remove_emoji():
     if not user_has_permission(guild, cu['username'], "manage_guild"):
         return jsonify({"status":"error","message":"No permission"}),403
 
-    e_index = None
-    for i,e in enumerate(guild['emojis']):
-        if e['id'] == emoji_id:
-            e_index = i
-            break
-    if e_index is None:
+    if not find_emoji(guild, emoji_id):
         return jsonify({"status":"error","message":"Emoji not found"}),404
 
-    del guild['emojis'][e_index]
+    commit('remove_emoji', guild_id=guild_id, emoji_id=emoji_id)
+    publish_event('emoji_delete', {"emoji_id": emoji_id}, guild=guild)
     add_audit_log(guild, "REMOVE_EMOJI", cu['username'], f"Removed emoji {emoji_id}")
-    save_db(db)
     return jsonify({"status":"success","message":"Emoji removed"})
 
 ##########################
 # Üye Yönetimi (Kick / Ban)
 ##########################
 
+def disconnect_voice(db, guild, username):
+    # Sunucudan çıkarılan kullanıcının ses bağlantılarını kapatır
+    for channel_id in voice_state.leave_guild(guild['id'], username):
+        _, ch_obj = resolve_channel(db, channel_id)
+        publish_event('voice_leave', {"channel_id": channel_id, "username": username},
+                      guild=guild, channel=ch_obj)
+
 # /kick_member [POST]
 # {"guild_id":"...","username":"..."}
 @app.route('/kick_member', methods=['POST'])
@@ -1513,24 +4731,23 @@ def kick_member():
     guild_id = data.get('guild_id')
     target_user = data.get('username')
 
-    guild = find_guild(db, guild_id)
-    if not guild:
-        return jsonify({"status":"error","message":"Guild not found"}),404
+    with partition_locks.hold(('guild', guild_id), ('user', target_user)):
+        guild = find_guild(db, guild_id)
+        if not guild:
+            return jsonify({"status":"error","message":"Guild not found"}),404
 
-    if not user_has_permission(guild, cu['username'], "kick_members"):
-        return jsonify({"status":"error","message":"No permission"}),403
+        if not user_has_permission(guild, cu['username'], "kick_members"):
+            return jsonify({"status":"error","message":"No permission"}),403
+
+        if not is_guild_member(guild, target_user):
+            return jsonify({"status":"error","message":"User not in guild"}),404
 
-    mem = user_in_guild(guild, target_user)
-    if not mem:
-        return jsonify({"status":"error","message":"User not in guild"}),404
-
-    # Remove user from guild
-    guild['members'] = [m for m in guild['members'] if m['username'] != target_user]
-    t_user = find_user(db, target_user)
-    if guild_id in t_user['guilds']:
-        t_user['guilds'].remove(guild_id)
-    add_audit_log(guild, "KICK_MEMBER", cu['username'], f"Kicked {target_user}")
-    save_db(db)
+        # Remove user from guild
+        commit('remove_member', guild_id=guild_id, username=target_user)
+        commit('remove_user_guild', username=target_user, guild_id=guild_id)
+        publish_event('member_remove', {"username": target_user, "reason": "kick"}, guild=guild)
+        disconnect_voice(db, guild, target_user)
+        add_audit_log(guild, "KICK_MEMBER", cu['username'], f"Kicked {target_user}")
     return jsonify({"status":"success","message":"User kicked"})
 
 # /ban_member [POST]
@@ -1550,27 +4767,26 @@ def ban_member():
     guild_id = data.get('guild_id')
     target_user = data.get('username')
 
-    guild = find_guild(db, guild_id)
-    if not guild:
-        return jsonify({"status":"error","message":"Guild not found"}),404
+    # Aynı anda gelen bir davet katılımı ya da kick ile yarışmasın diye
+    # sunucu ve kullanıcı kilitleri birlikte alınır
+    with partition_locks.hold(('guild', guild_id), ('user', target_user)):
+        guild = find_guild(db, guild_id)
+        if not guild:
+            return jsonify({"status":"error","message":"Guild not found"}),404
 
-    if not user_has_permission(guild, cu['username'], "ban_members"):
-        return jsonify({"status":"error","message":"No permission"}),403
+        if not user_has_permission(guild, cu['username'], "ban_members"):
+            return jsonify({"status":"error","message":"No permission"}),403
 
-    mem = user_in_guild(guild, target_user)
-    if mem:
-        guild['members'] = [m for m in guild['members'] if m['username'] != target_user]
-        t_user = find_user(db, target_user)
-        if t_user and guild_id in t_user['guilds']:
-            t_user['guilds'].remove(guild_id)
+        if is_guild_member(guild, target_user):
+            commit('remove_member', guild_id=guild_id, username=target_user)
+            commit('remove_user_guild', username=target_user, guild_id=guild_id)
+            publish_event('member_remove', {"username": target_user, "reason": "ban"}, guild=guild)
+            disconnect_voice(db, guild, target_user)
 
-    if 'bans' not in guild:
-        guild['bans'] = []
-    if target_user not in guild['bans']:
-        guild['bans'].append(target_user)
+        commit('add_ban', guild_id=guild_id, username=target_user)
+        publish_event('ban_add', {"username": target_user}, guild=guild)
 
-    add_audit_log(guild, "BAN_MEMBER", cu['username'], f"Banned {target_user}")
-    save_db(db)
+        add_audit_log(guild, "BAN_MEMBER", cu['username'], f"Banned {target_user}")
     return jsonify({"status":"success","message":"User banned"})
 
 # /unban_member [POST]
@@ -1600,9 +4816,9 @@ def unban_member():
     if 'bans' not in guild or target_user not in guild['bans']:
         return jsonify({"status":"error","message":"User not banned"}),400
 
-    guild['bans'].remove(target_user)
+    commit('remove_ban', guild_id=guild_id, username=target_user)
+    publish_event('ban_remove', {"username": target_user}, guild=guild)
     add_audit_log(guild, "UNBAN_MEMBER", cu['username'], f"Unbanned {target_user}")
-    save_db(db)
     return jsonify({"status":"success","message":"User unbanned"})
 
 ##########################
@@ -1612,14 +4828,133 @@ def unban_member():
 @app.route('/audit_logs/<guild_id>', methods=['GET'])
 def audit_logs(guild_id):
     db = load_db()
-    guild = find_guild(db, guild_id)
-    if not guild:
+    if not guild_exists(db, guild_id):
         return jsonify({"status":"error","message":"Guild not found"}),404
 
-    return jsonify({"audit_logs": guild['audit_logs']})
+    # Kayıtlar yalnızca 304 veya önbellek isabeti yoksa okunur
+    return cached_listing(('audit_logs', guild_id), response_cache.version(('audit_logs', guild_id)),
+                          'audit_logs', lambda: guild_audit_logs(db, guild_id))
+
+##########################
+# Gerçek Zamanlı Olaylar
+##########################
+def event_subscriber(db):
+    """
+    /gateway ve /changes için ortak kontrol: token'ı (başlık veya ?token=)
+    doğrular ve ?guild_id / ?dm_id parametrelerini konu listesine çevirir.
+    Hiçbiri verilmezse kullanıcının tüm sunucu ve DM'leri alınır; kullanıcının
+    kendi konusu ('user:<ad>') her zaman eklenir.
+    Dönüş: (kullanıcı, guild_ids, dm_ids, konular, None) veya hata yanıtıyla (..., hata).
+    """
+    auth = request.headers.get('Authorization')
+    token = request.args.get('token')
+    if auth and auth.startswith("Bearer "):
+        token = auth.split(" ")[1]
+    if not token:
+        return None, None, None, None, (jsonify({"status":"error","message":"Unauthorized"}),401)
+    cu = find_user_by_token(db, token)
+    if not cu:
+        return None, None, None, None, (jsonify({"status":"error","message":"Invalid token"}),401)
+
+    guild_ids = request.args.getlist('guild_id')
+    dm_ids = request.args.getlist('dm_id')
+    if not guild_ids and not dm_ids:
+        guild_ids = cu['guilds']
+        dm_ids = cu['dm_channels']
+
+    topics = {'user:' + cu['username']}
+    for guild_id in guild_ids:
+        guild = find_guild(db, guild_id)
+        if not guild:
+            return cu, None, None, None, (jsonify({"status":"error","message":"Guild not found"}),404)
+        if not is_guild_member(guild, cu['username']):
+            return cu, None, None, None, (jsonify({"status":"error","message":"Not in guild"}),403)
+        topics.add('guild:' + guild_id)
+    for dm_id in dm_ids:
+        dm_obj = find_dm(db, dm_id)
+        if not dm_obj:
+            return cu, None, None, None, (jsonify({"status":"error","message":"DM not found"}),404)
+        if cu['username'] not in dm_obj['participants']:
+            return cu, None, None, None, (jsonify({"status":"error","message":"Not a participant"}),403)
+        topics.add('dm:' + dm_id)
+    return cu, guild_ids, dm_ids, topics, None
+
+# /gateway [GET]
+# Server-Sent Events akışı. EventSource başlık gönderemediği için token
+# ?token=... olarak da verilebilir. guild_id ve dm_id birden çok kez verilebilir.
+@app.route('/gateway', methods=['GET'])
+def gateway():
+    db = load_db()
+    cu, guild_ids, dm_ids, topics, error = event_subscriber(db)
+    if error:
+        return error
+
+    username = cu['username']
+
+    def stream():
+        # Abonelik akış başlayınca açılır ve bağlantı kapanınca kaldırılır
+        sub = event_bus.subscribe(username, topics)
+        try:
+            yield sse_frame('ready', json.dumps({"guild_ids": guild_ids, "dm_ids": dm_ids}))
+            while True:
+                try:
+                    frame = sub.queue.get(timeout=GATEWAY_HEARTBEAT)
+                except queue.Empty:
+                    yield ': ping\n\n'
+                    continue
+                yield frame
+                if sub.overflowed:
+                    yield sse_frame('resync', '{}')
+                    return
+        finally:
+            event_bus.unsubscribe(sub)
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# /changes [GET]
+# Long-poll: ?since=<seq> sonrasında değişiklik yoksa ?timeout=<saniye>
+# (varsayılan 25) kadar bekler. since verilmezse beklemeden güncel imleç döner.
+@app.route('/changes', methods=['GET'])
+def changes():
+    db = load_db()
+    cu, _, _, topics, error = event_subscriber(db)
+    if error:
+        return error
+
+    if request.args.get('since') is None:
+        return jsonify({"changes": [], "cursor": event_bus.seq, "reset": False})
+    try:
+        since = int(request.args['since'])
+    except ValueError:
+        since = -1
+    if since < 0:
+        return jsonify({"status":"error","message":"Invalid cursor"}),400
+    try:
+        timeout = float(request.args.get('timeout', 25))
+    except ValueError:
+        timeout = math.nan
+    if not math.isfinite(timeout):
+        return jsonify({"status":"error","message":"Invalid timeout"}),400
+    timeout = min(max(timeout, 0), CHANGES_MAX_TIMEOUT)
+
+    found, cursor, reset = event_bus.changes(cu['username'], topics, since, timeout)
+    return jsonify({"changes": found, "cursor": cursor, "reset": reset})
+
+##########################
+# Sunucu İstatistikleri
+##########################
+
+# /stats [GET]
+@app.route('/stats', methods=['GET'])
+def stats():
+    db = load_db()
+    return jsonify({"storage": db.stats(), "recent_messages": recent_messages.stats(),
+                    "responses": response_cache.stats()})
 
 ##########################
 # Uygulama Başlatma
 ##########################
 if __name__ == '__main__':
-    app.run(debug=True)
+    # İstekler thread'lerde paralel işlenir; yazılar bölüm kilitleriyle korunur
+    app.run(debug=True, threaded=True)